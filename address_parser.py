@@ -0,0 +1,101 @@
+import re
+from functools import lru_cache
+
+# Spanish postal codes have 5 digits
+POSTAL_CODE_SEARCH = re.compile(r'\d{5}\b')
+POSTAL_CODE_REMOVE = re.compile(r'\b\d{5}\b')
+# The last parts of an address hold the postal code, city, state and country
+TAIL_PARTS = 3
+
+
+def has_postal_code(address_element):
+    # Regular expression to find if the address element has a spanish postal code (5 digits)
+    return POSTAL_CODE_SEARCH.search(address_element) is not None
+
+
+def remove_postal_code(text):
+    """Remove postal code from passed text"""
+    return POSTAL_CODE_REMOVE.sub('', text).strip()
+
+
+def _consume_part(fields, part, address_parts):
+    """ Assigns an address part, walking the address from the end """
+    if fields['postal_code'] == '' and has_postal_code(part):
+        subpart = part.split(' ', 1)
+        if len(subpart) == 2:
+            fields['postal_code'] = subpart[0]
+            fields['city'] = subpart[1]
+        else:
+            fields['postal_code'] = subpart[0]
+
+    if fields['country'] == '':
+        fields['country'] = part
+    elif fields['state'] == '':
+        fields['state'] = part
+    elif fields['city'] == '' or fields['city'] in part:
+        fields['city'] = part
+    else:
+        address_parts.append(part)
+
+
+@lru_cache(maxsize=4096)
+def _parse_tail(tail):
+    """ Parses the reversed last parts of an address, which repeat across thousands of addresses """
+    fields = {'country': '', 'state': '', 'city': '', 'postal_code': ''}
+    address_parts = []
+    for part in tail:
+        _consume_part(fields, part, address_parts)
+
+    return fields['country'], fields['state'], fields['city'], fields['postal_code'], tuple(address_parts)
+
+
+@lru_cache(maxsize=4096)
+def _remove_repeated_postal_code(text):
+    """ remove_postal_code for the country, state and city values, which repeat across addresses """
+    return remove_postal_code(text)
+
+
+def parse_address(address_string):
+    """ Returns the country, state, city, address and postal code of a Google formatted address """
+    splitted_result = [part.strip() for part in address_string.split(',')]
+    splitted_result.reverse()
+
+    country, state, city, postal_code, tail_address_parts = _parse_tail(tuple(splitted_result[:TAIL_PARTS]))
+    address_parts = list(tail_address_parts)
+
+    if len(splitted_result) > TAIL_PARTS:
+        fields = {'country': country, 'state': state, 'city': city, 'postal_code': postal_code}
+        for part in splitted_result[TAIL_PARTS:]:
+            _consume_part(fields, part, address_parts)
+        country, state, city, postal_code = fields['country'], fields['state'], fields['city'], fields['postal_code']
+
+    country = _remove_repeated_postal_code(country)
+    state = _remove_repeated_postal_code(state)
+    city = _remove_repeated_postal_code(city)
+    address_parts.reverse()
+    address = ', '.join(remove_postal_code(part) for part in address_parts)
+
+    if city == '':
+        city = state
+
+    return country, state, city, address, postal_code
+
+
+def parse_addresses(address_strings):
+    """ Parses a whole page of addresses, each distinct address is parsed once """
+    parsed = {}
+    return [parsed[address] if address in parsed else parsed.setdefault(address, parse_address(address))
+            for address in address_strings]
+
+
+def full_address(address, state, city, postal_code):
+    """ 'address, state, city, postal code' as exported, None when a part is missing """
+    parts = (address, state, city, postal_code)
+    return None if None in parts else ', '.join(parts)
+
+
+def search_url(name, address):
+    """ Google search of the reviews of a company """
+    if name is None or address is None:
+        return None
+    return f"https://www.google.com/search?q={f'{name} {address}'.replace(' ', '+').replace(',', '%2C')}+opiniones"
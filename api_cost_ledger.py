@@ -0,0 +1,157 @@
+import datetime
+import time
+import uuid
+
+
+class ApiCostLedger:
+    """ Keeps the running monthly API spend in memory. Budget is reserved from the database in chunks with a
+        single conditional statement, so several processes sharing the database can never spend more than
+        max_monthly_cost between them. The spent cost is written to api_costs in batches.
+
+        Reservations of a process that dies without releasing them expire after reservation_timeout seconds.
+    """
+
+    def __init__(self, conn, lock, max_monthly_cost, chunk_size=0.5, flush_every=20, reservation_timeout=3600):
+        self.conn = conn
+        self.lock = lock
+        self.max_monthly_cost = max_monthly_cost
+        self.chunk_size = chunk_size
+        self.flush_every = flush_every
+        self.reservation_timeout = reservation_timeout
+        self.owner = uuid.uuid4().hex
+        self.year = self.month = None
+        self.reserved = 0.0
+        self.pending_cost = 0.0
+        self.pending_queries = 0
+        self.pending_by_type = {}
+
+    def register(self, request_type, cost):
+        """ Registers a request of request_type. Returns False if it would exceed the monthly limit """
+        with self.lock:
+            self._check_month()
+
+            available = round(self.reserved - self.pending_cost, 6)
+            if cost > available:
+                # Ask for a full chunk first, then for just what we need when we are close to the limit
+                if not self._reserve(max(self.chunk_size, cost - available)) and not self._reserve(cost - available):
+                    return False
+
+            self.pending_cost = round(self.pending_cost + cost, 6)
+            self.pending_queries += 1
+            type_queries, type_cost = self.pending_by_type.get(request_type, (0, 0.0))
+            self.pending_by_type[request_type] = (type_queries + 1, round(type_cost + cost, 6))
+
+            if self.pending_queries >= self.flush_every:
+                self.flush()
+
+        return True
+
+    def refund(self, request_type, cost):
+        """ Gives back the cost of a registered request that Google did not bill """
+        with self.lock:
+            type_queries, type_cost = self.pending_by_type.get(request_type, (0, 0.0))
+            self.pending_by_type[request_type] = (type_queries - 1, round(type_cost - cost, 6))
+            self.pending_cost = round(self.pending_cost - cost, 6)
+            self.pending_queries -= 1
+
+    def monthly_cost(self):
+        """ Returns the cost spent this month by every process, including our unflushed requests """
+        with self.lock:
+            self.flush()
+            year, month = self._today()
+            row = self.conn.execute('SELECT cost FROM api_costs WHERE year = ? AND month = ?',
+                                    (year, month)).fetchone()
+        return row[0] if row else 0.0
+
+    def costs_by_type(self):
+        """ Returns {request_type: (query_count, cost)} for the current month """
+        with self.lock:
+            self.flush()
+            year, month = self._today()
+            rows = self.conn.execute('''
+                SELECT request_type, query_count, cost FROM api_costs_by_type WHERE year = ? AND month = ?
+            ''', (year, month)).fetchall()
+        return {request_type: (query_count, cost) for request_type, query_count, cost in rows}
+
+    def flush(self):
+        """ Writes the pending spend to the database and shrinks our reservation by the same amount """
+        with self.lock:
+            if not self.pending_by_type:
+                return
+
+            self.conn.execute('''
+                UPDATE api_costs SET cost = ROUND(cost + ?, 6), query_count = query_count + ?
+                WHERE year = ? AND month = ?
+            ''', (self.pending_cost, self.pending_queries, self.year, self.month))
+            self.conn.executemany('''
+                INSERT INTO api_costs_by_type (year, month, request_type, query_count, cost)
+                VALUES (?, ?, ?, ?, ?) ON CONFLICT(year, month, request_type) DO
+                UPDATE SET query_count = query_count + excluded.query_count, cost = ROUND(cost + excluded.cost, 6)
+            ''', [(self.year, self.month, request_type, queries, cost)
+                  for request_type, (queries, cost) in self.pending_by_type.items()])
+            updated = self.conn.execute('''
+                UPDATE api_cost_reservations SET amount = ROUND(amount - ?, 6), updated_at = ?
+                WHERE owner = ? AND year = ? AND month = ?
+            ''', (self.pending_cost, time.time(), self.owner, self.year, self.month)).rowcount
+            self.conn.commit()
+
+            # Our reservation expired and was reclaimed by another process, reserve again on the next request
+            self.reserved = round(self.reserved - self.pending_cost, 6) if updated else 0.0
+            self.pending_cost = 0.0
+            self.pending_queries = 0
+            self.pending_by_type = {}
+
+    def close(self):
+        """ Flushes the pending spend and releases the unused reserved budget """
+        with self.lock:
+            if self.year is None:
+                return
+            self.flush()
+            self._release()
+            self.year = self.month = None
+
+    def _check_month(self):
+        year, month = self._today()
+        if (year, month) == (self.year, self.month):
+            return
+
+        if self.year is not None:
+            self.flush()
+            self._release()
+
+        self.year, self.month = year, month
+        self.conn.execute('INSERT OR IGNORE INTO api_costs (year, month, query_count, cost) VALUES (?, ?, 0, 0)',
+                          (year, month))
+        self.conn.commit()
+
+    def _reserve(self, amount):
+        """ Atomically reserves amount of the monthly budget, the limit check and the reservation are a
+            single statement so it holds across processes """
+        amount = round(amount, 6)
+        now = time.time()
+        self.conn.execute('DELETE FROM api_cost_reservations WHERE updated_at < ?', (now - self.reservation_timeout,))
+        inserted = self.conn.execute('''
+            INSERT INTO api_cost_reservations (owner, year, month, amount, updated_at)
+            SELECT ?, ?, ?, ?, ?
+            WHERE (SELECT cost FROM api_costs WHERE year = ? AND month = ?)
+                + (SELECT IFNULL(SUM(amount), 0) FROM api_cost_reservations WHERE year = ? AND month = ?)
+                + ? <= ?
+            ON CONFLICT(owner, year, month) DO UPDATE SET amount = ROUND(amount + excluded.amount, 6),
+                updated_at = excluded.updated_at
+        ''', (self.owner, self.year, self.month, amount, now, self.year, self.month, self.year, self.month,
+              amount, self.max_monthly_cost + 1e-9)).rowcount
+        self.conn.commit()
+
+        if inserted:
+            self.reserved = round(self.reserved + amount, 6)
+        return inserted > 0
+
+    def _release(self):
+        self.conn.execute('DELETE FROM api_cost_reservations WHERE owner = ?', (self.owner,))
+        self.conn.commit()
+        self.reserved = 0.0
+
+    @staticmethod
+    def _today():
+        today = datetime.date.today()
+        return today.year, today.month
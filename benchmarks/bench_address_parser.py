@@ -0,0 +1,103 @@
+""" Checks address_parser against the golden corpus (fields extracted by the original parser) and compares its speed
+    with the original implementation, parsing the corpus page by page.
+
+    Usage: python benchmarks/bench_address_parser.py [repetitions]
+"""
+import json
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import address_parser  # noqa: E402
+
+CORPUS_PATH = os.path.join(ROOT, 'benchmarks', 'address_corpus.json')
+PAGE_SIZE = 20
+
+
+def original_parse_address(address_string):
+    """ GooglePlacesManager.parse_address before address_parser, uncompiled patterns and no cache """
+    def has_postal_code(address_element):
+        return bool(re.search(r'\d{5}\b', address_element))
+
+    def remove_postal_code(text):
+        return re.sub(r'\b\d{5}\b', '', text).strip()
+
+    country = state = city = address = postal_code = ''
+    splitted_result = address_string.split(',')
+    splitted_result.reverse()
+    address_parts = []
+
+    for part in splitted_result:
+        part = part.strip()
+        if postal_code == '' and has_postal_code(part):
+            subpart = part.split(' ', 1)
+            if len(subpart) == 2:
+                postal_code = subpart[0]
+                city = subpart[1]
+            else:
+                postal_code = subpart[0]
+
+        if country == '':
+            country = part
+        elif state == '':
+            state = part
+        elif city == '' or city in part:
+            city = part
+        else:
+            address_parts.append(part)
+
+    country = remove_postal_code(country)
+    state = remove_postal_code(state)
+    city = remove_postal_code(city)
+    address_parts.reverse()
+    address_parts = [remove_postal_code(part) for part in address_parts]
+    address = ', '.join(address_parts)
+
+    if city == '':
+        city = state
+
+    return country, state, city, address, postal_code
+
+
+def check_golden(corpus):
+    mismatches = 0
+    parsed = address_parser.parse_addresses([entry['address'] for entry in corpus])
+    for entry, fields in zip(corpus, parsed):
+        if list(fields) != entry['expected']:
+            mismatches += 1
+            print(f"Mismatch for {entry['address']!r}: {list(fields)} != {entry['expected']}")
+    return mismatches
+
+
+def timed(label, parse_page, pages, repetitions):
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        for page in pages:
+            parse_page(page)
+    elapsed = time.perf_counter() - start
+    addresses = sum(len(page) for page in pages) * repetitions
+    print(f'{label:>9}: {addresses / elapsed:,.0f} addresses/s')
+    return elapsed
+
+
+if __name__ == '__main__':
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    with open(CORPUS_PATH, 'r', encoding='utf-8') as file:
+        corpus = json.load(file)
+
+    mismatches = check_golden(corpus)
+    if mismatches:
+        print(f'{mismatches} of {len(corpus)} golden addresses changed')
+        exit(1)
+    print(f'{len(corpus)} golden addresses match')
+
+    addresses = [entry['address'] for entry in corpus]
+    pages = [addresses[i:i + PAGE_SIZE] for i in range(0, len(addresses), PAGE_SIZE)]
+    before = timed('original', lambda page: [original_parse_address(address) for address in page], pages,
+                   repetitions)
+    after = timed('parser', address_parser.parse_addresses, pages, repetitions)
+    print(f'Speedup: x{before / after:.1f}')
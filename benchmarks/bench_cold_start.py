@@ -0,0 +1,92 @@
+""" Cold start benchmark of the CLI: wall time of each subcommand in a fresh process, next to a bare interpreter and
+    `import googlemaps`, and the manager start on a new database (schema created) against an up to date one (schema
+    check only). Runs in a temporary directory with the offline fake backend, no API key needed.
+
+    Usage: python benchmarks/bench_cold_start.py [--runs 10]
+"""
+import argparse
+import configparser
+import importlib.util
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = os.path.join(ROOT, 'cli.py')
+SECTIONS_PATH = os.path.join(ROOT, 'sections.json')
+MANAGER_START = ('import sys; sys.path.insert(0, {root!r}); from google_places_manager import GooglePlacesManager; '
+                 'GooglePlacesManager().close_connection()')
+
+
+def write_config(directory):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, 'config.example.ini'))
+    config['DEFAULT'].update({
+        'PlacesBackend': 'fake',
+        'DatabasePath': os.path.join(directory, 'bench.db'),
+        'RunReportPath': '',
+        'PrometheusTextfilePath': '',
+        'DEBUG': '0',
+    })
+    config['FAKE'] = {'SectionsPath': SECTIONS_PATH}
+    if config.has_section('CACHE'):
+        config['CACHE']['Mode'] = 'off'
+    with open(os.path.join(directory, 'config.ini'), 'w') as file:
+        config.write(file)
+
+
+def timed(command, runs, before=None):
+    """ Min and median wall seconds of the command in a new process """
+    durations = []
+    for _ in range(runs):
+        if before:
+            before()
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+    return min(durations), statistics.median(durations)
+
+
+def report(label, durations, baseline):
+    fastest, median = durations
+    print(f'{label:>28}: min {fastest * 1000:7.1f} ms, median {median * 1000:7.1f} ms, '
+          f'{(median - baseline) * 1000:+7.1f} ms over python')
+
+
+def remove_database(directory):
+    for suffix in ('', '-wal', '-shm'):
+        path = os.path.join(directory, 'bench.db' + suffix)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def main(runs):
+    with tempfile.TemporaryDirectory() as directory:
+        write_config(directory)
+        shutil.copy(SECTIONS_PATH, directory)
+        os.chdir(directory)
+        try:
+            baseline = timed([sys.executable, '-c', 'pass'], runs)
+            report('python -c pass', baseline, baseline[1])
+            if importlib.util.find_spec('googlemaps'):
+                report('import googlemaps', timed([sys.executable, '-c', 'import googlemaps'], runs), baseline[1])
+
+            manager_start = [sys.executable, '-c', MANAGER_START.format(root=ROOT)]
+            report('manager start, new database', timed(manager_start, runs, lambda: remove_database(directory)),
+                   baseline[1])
+            report('manager start, up to date', timed(manager_start, runs), baseline[1])
+
+            for subcommand in (['--help'], ['stats'], ['budget'], ['export', '--format', 'jsonl']):
+                report(f'cli.py {" ".join(subcommand)}', timed([sys.executable, CLI] + subcommand, runs), baseline[1])
+        finally:
+            os.chdir(ROOT)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cold start times of the CLI subcommands')
+    parser.add_argument('--runs', type=int, default=10, help='Runs of each command')
+    main(parser.parse_args().runs)
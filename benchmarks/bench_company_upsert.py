@@ -0,0 +1,87 @@
+""" Compares the company write strategies of search_and_store_companies on a temporary database:
+    - per_row: the previous strategy, one upsert and one commit per result with the default rollback journal.
+    - per_page: one executemany upsert and one commit per page of 20 results, WAL journal and synchronous=NORMAL.
+
+    Usage: python benchmarks/bench_company_upsert.py [rows]
+"""
+import os
+import sys
+import tempfile
+import time
+import sqlite3
+
+COMPANIES_PER_PAGE = 20
+
+CREATE_COMPANY = '''
+    CREATE TABLE company (
+        place_id TEXT PRIMARY KEY,
+        name TEXT,
+        section_id INTEGER,
+        country TEXT,
+        state TEXT,
+        city TEXT,
+        address TEXT,
+        postal_code TEXT,
+        updated_at DATE,
+        detail_updated_at DATE
+    )
+'''
+
+UPSERT_COMPANY = '''
+    INSERT INTO company (place_id, name, section_id, country, state, city, address, postal_code, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(place_id) DO
+    UPDATE SET name = excluded.name, section_id = excluded.section_id, country = excluded.country,
+    state = excluded.state, city = excluded.city, address = excluded.address, postal_code = excluded.postal_code,
+    updated_at = excluded.updated_at
+'''
+
+
+def company_rows(count):
+    for i in range(count):
+        yield (f'place-{i}', f'Company {i}', i % 366, 'España', 'Madrid', 'Madrid', f'Calle Mayor, {i}',
+               f'28{i % 1000:03d}', '2024-01-01')
+
+
+def per_row(conn, rows):
+    for row in rows:
+        conn.execute(UPSERT_COMPANY, row)
+        conn.commit()
+
+
+def per_page(conn, rows):
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA cache_size = -20000')
+
+    page = []
+    for row in rows:
+        page.append(row)
+        if len(page) == COMPANIES_PER_PAGE:
+            conn.executemany(UPSERT_COMPANY, page)
+            conn.commit()
+            page = []
+    if page:
+        conn.executemany(UPSERT_COMPANY, page)
+        conn.commit()
+
+
+def run(strategy, count):
+    with tempfile.TemporaryDirectory() as directory:
+        conn = sqlite3.connect(os.path.join(directory, 'bench.db'))
+        conn.execute(CREATE_COMPANY)
+        conn.commit()
+
+        start = time.perf_counter()
+        strategy(conn, company_rows(count))
+        elapsed = time.perf_counter() - start
+        conn.close()
+
+    print(f'{strategy.__name__:>10}: {count} rows in {elapsed:.2f}s -> {count / elapsed:,.0f} rows/s')
+    return count / elapsed
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    before = run(per_row, rows)
+    after = run(per_page, rows)
+    print(f'Speedup: x{after / before:.1f}')
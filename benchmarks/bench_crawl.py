@@ -0,0 +1,148 @@
+""" Load benchmark of the whole manager against the offline fake Places backend (fake_places.py), no API key needed.
+    For each scale, a temporary database is filled with that many companies, then update_companies crawls some
+    sections and update_company_details refreshes some companies. Reports companies/s, API calls and cost per
+    company, and the SQLite write throughput.
+
+    Usage: python benchmarks/bench_crawl.py [companies ...] [--latency 0.05] [--sections 10] [--details 1000]
+    e.g. python benchmarks/bench_crawl.py 10000 100000 1000000
+"""
+import argparse
+import configparser
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import address_parser  # noqa: E402
+from google_places_manager import GooglePlacesManager  # noqa: E402
+
+SECTIONS_PATH = os.path.join(ROOT, 'sections.json')
+PAGE_SIZE = 20
+
+
+def write_config(directory, density, args):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, 'config.example.ini'))
+    config['DEFAULT'].update({
+        'PlacesBackend': 'fake',
+        'DatabasePath': os.path.join(directory, 'bench.db'),
+        'MaxMonthlyCost': '1000000',
+        'PageTokenDelay': str(args.token_delay),
+        'SearchWorkers': str(args.workers),
+        'DetailsWorkers': str(args.workers),
+        'RunReportPath': os.path.join(directory, 'run_report.jsonl'),
+        'PrometheusTextfilePath': '',
+        'DEBUG': '0',
+    })
+    for key in ('PlaceDetailsQps', 'TextSearchQps', 'PlacePhotoQps'):
+        config['DEFAULT'][key] = '0'
+    config['FAKE'] = {
+        'SectionsPath': SECTIONS_PATH,
+        'Latency': str(args.latency),
+        'ErrorRate': str(args.error_rate),
+        'PageTokenDelay': str(args.token_delay),
+        'Density': str(density),
+    }
+    if config.has_section('CACHE'):
+        config['CACHE']['Mode'] = 'off'
+    with open(os.path.join(directory, 'config.ini'), 'w') as file:
+        config.write(file)
+
+
+def load_companies(manager):
+    """ Stores every fake place page by page, like the crawl does, and returns the rows/s """
+    rows = 0
+    start = time.perf_counter()
+    page = []
+    for result in manager.gmaps.iter_places():
+        page.append(result)
+        if len(page) == PAGE_SIZE:
+            rows += store_page(manager, page)
+            page = []
+    rows += store_page(manager, page)
+    return rows, rows / (time.perf_counter() - start)
+
+
+def store_page(manager, page):
+    today_str = time.strftime('%Y-%m-%d')
+    parsed = address_parser.parse_addresses([result['formatted_address'] for result in page])
+    company_rows = [(result['place_id'], result['name'], int(result['place_id'].split('-')[1]) + 1, country, state,
+                     city, address, postal_code, today_str, result['geometry']['location']['lat'],
+                     result['geometry']['location']['lng'])
+                    for result, (country, state, city, address, postal_code) in zip(page, parsed)]
+    if company_rows:
+        manager.store_companies(company_rows)
+    return len(company_rows)
+
+
+def last_report(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.loads(file.readlines()[-1])
+
+
+def per_company(value, companies):
+    return value / companies if companies else float('nan')
+
+
+def run_scale(companies, args):
+    with open(SECTIONS_PATH, 'r') as file:
+        population = sum(section['population'] for section in json.load(file).values())
+    density = companies / population * 1000
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_config(directory, density, args)
+        os.chdir(directory)
+        shutil.copy(SECTIONS_PATH, directory)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                manager = GooglePlacesManager()
+                manager.insert_section_data_samples()
+                loaded, load_rate = load_companies(manager)
+
+                manager.update_companies(args.sections)
+                crawl = last_report(manager.run_report_path)
+                manager.update_company_details(30, args.details)
+                details = last_report(manager.run_report_path)
+                manager.close_connection()
+        finally:
+            os.chdir(ROOT)
+
+    crawled = sum(row['rows'] for row in crawl['rows'])
+    searches = crawl['requests'].get('text_search', {})
+    page_writes = crawl['sql'].get('store_search_page', {})
+    refreshed = details['sql'].get('store_company_details', {}).get('count', 0)
+    details_calls = sum(summary['count'] for summary in details['requests'].values())
+
+    print(f'{loaded:,} companies')
+    print(f'  load: {load_rate:,.0f} rows/s stored page by page')
+    print(f'  crawl: {crawled:,} companies from {args.sections} sections in {crawl["duration"]}s, '
+          f'{per_company(crawled, crawl["duration"]):,.0f} companies/s, '
+          f'{per_company(searches.get("count", 0), crawled):.3f} calls and '
+          f'${per_company(crawl["cost"], crawled):.4f} per company, '
+          f'{per_company(page_writes.get("rows", 0), page_writes.get("sum", 0)):,.0f} rows/s written')
+    print(f'  details: {refreshed:,} companies in {details["duration"]}s, '
+          f'{per_company(refreshed, details["duration"]):,.0f} companies/s, '
+          f'{per_company(details_calls, refreshed):.2f} calls and ${per_company(details["cost"], refreshed):.4f} '
+          f'per company')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load benchmark against the fake Places backend')
+    parser.add_argument('companies', type=int, nargs='*', default=[10000])
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds per fake API call')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--token-delay', type=float, default=0.2, help='Seconds before a page token is valid')
+    parser.add_argument('--workers', type=int, default=8, help='SearchWorkers and DetailsWorkers')
+    parser.add_argument('--sections', type=int, default=10, help='Sections crawled by update_companies')
+    parser.add_argument('--details', type=int, default=1000, help='Companies refreshed by update_company_details')
+    args = parser.parse_args()
+
+    for companies in args.companies:
+        run_scale(companies, args)
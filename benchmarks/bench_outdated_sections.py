@@ -0,0 +1,164 @@
+""" Compares the outdated sections and stale details selection before and after the lookup indexes, the
+    section.last_crawled_at and company.refresh_due_at columns, on a synthetic database with sections.json and
+    `companies` companies. The stale details are selected as GooglePlacesManager.update_company_details does.
+
+    Usage: python benchmarks/bench_outdated_sections.py [companies]
+"""
+import datetime
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from refresh_planner import FIELD_GROUPS, RefreshPlanner  # noqa: E402
+
+SECTIONS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sections.json')
+
+OLD_OUTDATED_SECTIONS = '''
+    SELECT s.section_id FROM section s
+    LEFT JOIN company c ON c.section_id = s.section_id
+    ORDER BY c.updated_at ASC, RANDOM()
+    LIMIT 20
+'''
+NEW_OUTDATED_SECTIONS = '''
+    SELECT section_id FROM section
+    ORDER BY last_crawled_at ASC, section_id ASC
+    LIMIT 20
+'''
+OLD_STALE_DETAILS = '''
+    SELECT place_id, name FROM company
+    WHERE (julianday(?) - julianday(detail_updated_at)) > (?) OR detail_updated_at IS NULL
+    ORDER BY section_id ASC LIMIT 200
+'''
+NEW_STALE_DETAILS = '''
+    SELECT c.place_id, c.name, c.detail_updated_at, cd.place_id IS NOT NULL AS has_details,
+    cd.contact_updated_at, cd.atmosphere_updated_at, cd.hours_updated_at, cd.photo_updated_at,
+    cd.total_reviews, cd.review_velocity, cd.photo_reference, cd.place_photo, cd.photo_file
+    FROM company c
+    LEFT JOIN company_details cd ON cd.place_id = c.place_id
+    WHERE c.duplicate_of IS NULL AND c.refresh_due_at < :today
+    ORDER BY c.refresh_due_at
+    LIMIT :candidates
+'''
+REFRESH_DAYS = 30
+REFRESH_LIMIT = 200
+REFRESH_CANDIDATES_PER_COMPANY = 4
+
+def random_date(rng, today):
+    return (today - datetime.timedelta(days=rng.randint(0, 120))).strftime('%Y-%m-%d')
+
+
+def build_database(conn, companies):
+    rng = random.Random(42)
+    today = datetime.date.today()
+
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('''
+        CREATE TABLE section (
+            section_id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, lat FLOAT, lon FLOAT, population FLOAT,
+            radius FLOAT, parent_section_id INTEGER, last_crawled_at DATETIME, covered_by_section_id INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE company (
+            place_id TEXT PRIMARY KEY, name TEXT, section_id INTEGER, country TEXT, state TEXT, city TEXT,
+            address TEXT, postal_code TEXT, updated_at DATE, detail_updated_at DATE, duplicate_of TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE company_details (
+            place_id TEXT PRIMARY KEY, website TEXT, phone_number TEXT, total_reviews INTEGER, avg_reviews FLOAT,
+            opening_hours TEXT, place_photo TEXT, photo_reference TEXT, photo_file TEXT, review_velocity REAL,
+            updated_at DATE, contact_updated_at DATE, atmosphere_updated_at DATE, hours_updated_at DATE,
+            photo_updated_at DATE
+        )
+    ''')
+
+    with open(SECTIONS_PATH, 'r') as file:
+        sections = json.load(file)
+    conn.executemany('INSERT INTO section (name, lat, lon, population) VALUES (?, ?, ?, ?)',
+                     [(name, data['lat'], data['lon'], data['population']) for name, data in sections.items()])
+
+    batch, details_batch = [], []
+    for i in range(companies):
+        detail_updated_at = None if rng.random() < 0.05 else random_date(rng, today)
+        batch.append((f'place-{i}', f'Company {i}', rng.randint(1, len(sections)), 'España', 'Madrid', 'Madrid',
+                      f'Calle {i}', '28001', random_date(rng, today), detail_updated_at, None))
+        if detail_updated_at is not None:
+            details_batch.append((f'place-{i}', rng.randint(0, 500), round(rng.uniform(0, 1), 3), detail_updated_at)
+                                 + tuple(random_date(rng, today) for _ in FIELD_GROUPS))
+        if len(batch) == 50000:
+            insert_companies(conn, batch, details_batch)
+            batch, details_batch = [], []
+    insert_companies(conn, batch, details_batch)
+    conn.commit()
+
+
+def insert_companies(conn, batch, details_batch):
+    conn.executemany('INSERT INTO company VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+    conn.executemany('''
+        INSERT INTO company_details (place_id, total_reviews, review_velocity, updated_at, contact_updated_at,
+        atmosphere_updated_at, hours_updated_at, photo_updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', details_batch)
+
+def migrate(conn):
+    """ Same changes as GooglePlacesManager._migration_lookup_indexes and _migration_refresh_due_dates, and the
+        refresh due dates computed by the first details refresh """
+    conn.execute('CREATE INDEX idx_company_section_updated_at ON company (section_id, updated_at)')
+    conn.execute('CREATE INDEX idx_company_detail_updated_at ON company (detail_updated_at)')
+    conn.execute('CREATE INDEX idx_section_last_crawled_at ON section (last_crawled_at)')
+    conn.execute('''
+        UPDATE section SET last_crawled_at = (
+            SELECT MAX(c.updated_at) FROM company c WHERE c.section_id = section.section_id
+        ) WHERE last_crawled_at IS NULL
+    ''')
+    conn.execute("ALTER TABLE company ADD COLUMN refresh_due_at DATE DEFAULT ''")
+    conn.execute('CREATE INDEX idx_company_refresh_due ON company (refresh_due_at) WHERE duplicate_of IS NULL')
+    schedule = {group: REFRESH_DAYS for group in FIELD_GROUPS}
+    conn.execute(f'''
+        UPDATE company SET refresh_due_at = IFNULL((
+            SELECT {RefreshPlanner.due_date_sql(schedule)} FROM company_details cd WHERE cd.place_id = company.place_id
+        ), '')
+    ''')
+    conn.commit()
+
+
+def timed(label, conn, sql, params=(), repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = conn.execute(sql, params).fetchall()
+        best = min(best, time.perf_counter() - start)
+    print(f'{label:>28}: {best * 1000:10.2f} ms ({len(rows)} rows, {len({row[0] for row in rows})} distinct)')
+    return best
+
+
+if __name__ == '__main__':
+    companies = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    today = datetime.date.today()
+
+    with tempfile.TemporaryDirectory() as directory:
+        conn = sqlite3.connect(os.path.join(directory, 'bench.db'))
+        start = time.perf_counter()
+        build_database(conn, companies)
+        print(f'Built a database with {companies} companies in {time.perf_counter() - start:.1f}s')
+
+        old_sections = timed('outdated sections (before)', conn, OLD_OUTDATED_SECTIONS, repeat=1)
+        old_details = timed('stale details (before)', conn, OLD_STALE_DETAILS, (today, REFRESH_DAYS))
+
+        start = time.perf_counter()
+        migrate(conn)
+        print(f'Migrated in {time.perf_counter() - start:.1f}s')
+
+        new_sections = timed('outdated sections (after)', conn, NEW_OUTDATED_SECTIONS)
+        new_details = timed('stale details (after)', conn, NEW_STALE_DETAILS,
+                            {'today': today.strftime('%Y-%m-%d'),
+                             'candidates': REFRESH_LIMIT * REFRESH_CANDIDATES_PER_COMPANY})
+        print(f'Speedup: outdated sections x{old_sections / new_sections:,.0f}, '
+              f'stale details x{old_details / new_details:,.0f}')
+        conn.close()
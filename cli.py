@@ -0,0 +1,226 @@
+""" Single entry point of the manager:
+
+    python cli.py crawl [--sections 10]                  Crawls the outdated sections, resuming the unfinished job
+    python cli.py refresh [--days 30] [--limit 200]      Refreshes the stale company details
+    python cli.py export [--format csv] [--incremental]  Exports the companies with their details
+    python cli.py stats [--by province|city|month]       Counts of the database, or its aggregates
+    python cli.py budget                                 API cost of the month
+    python cli.py serve [--port 8000]                    Read only HTTP endpoint of the aggregates, see read_api.py
+
+Subcommands import what they need: export, stats, budget and serve don't import the Places client, and only build the
+manager to migrate a database created by an older version. The manager only creates or migrates the schema when the
+database is not up to date.
+"""
+import argparse
+import configparser
+import datetime
+import os
+import sqlite3
+import sys
+import threading
+
+STATS_QUERIES = (
+    ('Companies', 'SELECT COUNT(*) FROM company'),
+    ('Duplicate listings', 'SELECT COUNT(*) FROM company WHERE duplicate_of IS NOT NULL'),
+    ('Companies with details', 'SELECT COUNT(*) FROM company_details'),
+    ('Reviews', 'SELECT COUNT(*) FROM review'),
+    ('Sections', 'SELECT COUNT(*) FROM section'),
+    ('Sections never crawled', 'SELECT COUNT(*) FROM section WHERE last_crawled_at IS NULL'),
+    ('Running crawl jobs', "SELECT COUNT(*) FROM crawl_job WHERE state = 'running'"),
+    ('Crawl pages left', "SELECT COUNT(*) FROM crawl_item WHERE state IN ('pending', 'in_flight')"),
+)
+
+
+def read_config():
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    return config
+
+
+def database_path(config):
+    """ DatabasePath of config.ini, None when the file doesn't exist: sqlite would create an empty database """
+    path = config['DEFAULT']['DatabasePath']
+    if not os.path.exists(path):
+        print(f'Database {path} not found, check DatabasePath in config.ini or run `cli.py crawl` to create it')
+        return None
+    return path
+
+
+def connect(config, migrate=False):
+    """ Connection to the database, None when it doesn't exist. migrate applies the pending schema migrations first,
+        building the manager only if the database is behind. """
+    path = database_path(config)
+    if path is None:
+        return None
+    conn = sqlite3.connect(path)
+    if not migrate:
+        return conn
+
+    from google_places_manager import ConfigError, GooglePlacesManager
+
+    if not GooglePlacesManager.schema_up_to_date(conn):
+        print('Migrating the database schema...')
+        try:
+            GooglePlacesManager().close_connection()
+        except ConfigError:
+            conn.close()
+            return None
+    return conn
+
+
+def run_manager(method, *args):
+    """ Builds the manager and runs one of its methods, returns the exit code """
+    from google_places_manager import ConfigError, GooglePlacesManager
+    from request_executor import BudgetExhaustedError
+
+    try:
+        manager = GooglePlacesManager()
+        if method == 'update_companies':
+            manager.insert_section_data_samples()
+        getattr(manager, method)(*args)
+    except (BudgetExhaustedError, ConfigError):
+        return 1
+    return 0
+
+
+def crawl(args):
+    return run_manager('update_companies', args.sections)
+
+
+def refresh(args):
+    return run_manager('update_company_details', args.days, args.limit)
+
+
+def export(args):
+    import data_exporter
+
+    conn = connect(read_config(), migrate=True)
+    if conn is None:
+        return 1
+    output = args.output or f'exported_data.{args.format}'
+    exported = data_exporter.export(conn, output, args.format, args.incremental, args.batch_size)
+    print(f'Exported {exported} rows into {output}')
+    conn.close()
+    return 0
+
+
+def stats(args):
+    conn = connect(read_config(), migrate=True)
+    if conn is None:
+        return 1
+    if args.by:
+        return aggregate_stats(conn, args)
+    for label, query in STATS_QUERIES:
+        print(f'{label:>24}: {conn.execute(query).fetchone()[0]:,}')
+    conn.close()
+    return 0
+
+
+def aggregate_stats(conn, args):
+    """ Prints a page of the aggregates of the read API """
+    from read_api import ReadApi
+
+    api = ReadApi(conn)
+    try:
+        if args.by == 'month':
+            result = api.review_months(args.page, args.page_size)
+        else:
+            result = api.provinces(args.page, args.page_size) if args.by == 'province' else \
+                api.cities(args.province, args.page, args.page_size)
+    finally:
+        conn.close()
+
+    for item in result['items']:
+        if args.by == 'month':
+            print(f"{item['month']:>8}: {item['reviews']:,} reviews, average rating {item['avg_rating']}")
+            continue
+        name = item['province'] if args.by == 'province' else f"{item['city']} ({item['province']})"
+        print(f"{name:>32}: {item['companies']:,} companies, {item['details_coverage']:.0%} with details, "
+              f"average rating {item['avg_rating']}, {item['reviews']:,} reviews")
+    print(f"Page {result['page']} of {max(1, -(-result['total'] // result['page_size']))}")
+    return 0
+
+
+def serve(args):
+    import read_api
+
+    path = database_path(read_config())
+    if path is None:
+        return 1
+    read_api.serve(path, args.host, args.port)
+    return 0
+
+
+def budget(args):
+    from api_cost_ledger import ApiCostLedger
+
+    config = read_config()
+    conn = connect(config)
+    if conn is None:
+        return 1
+    max_monthly_cost = config['DEFAULT'].getfloat('MaxMonthlyCost')
+    ledger = ApiCostLedger(conn, threading.RLock(), max_monthly_cost)
+    try:
+        spent = ledger.monthly_cost()
+        by_type = ledger.costs_by_type()
+        today = datetime.date.today()
+        reserved = conn.execute('SELECT IFNULL(SUM(amount), 0) FROM api_cost_reservations WHERE year = ? AND month = ?',
+                                (today.year, today.month)).fetchone()[0]
+    except sqlite3.OperationalError:
+        print('No API costs recorded yet')
+        return 0
+    finally:
+        conn.close()
+
+    print(f'Spent ${spent:.3f} of ${max_monthly_cost:.2f} this month ({spent / max_monthly_cost:.1%}), '
+          f'${reserved:.3f} reserved by running processes')
+    for request_type, (queries, cost) in sorted(by_type.items()):
+        print(f'{request_type:>14}: {queries:,} requests, ${cost:.3f}')
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Google Places companies crawler')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    crawl_parser = subparsers.add_parser('crawl', help='Crawl the most outdated sections')
+    crawl_parser.add_argument('--sections', type=int, default=10, help='Sections searched by a new crawl job')
+    crawl_parser.set_defaults(func=crawl)
+
+    refresh_parser = subparsers.add_parser('refresh', help='Refresh the stale company details')
+    refresh_parser.add_argument('--days', type=int, default=30, help='Days before the details are stale')
+    refresh_parser.add_argument('--limit', type=int, default=200, help='Companies refreshed')
+    refresh_parser.set_defaults(func=refresh)
+
+    export_parser = subparsers.add_parser('export', help='Export the companies with their details')
+    export_parser.add_argument('--format', choices=('csv', 'jsonl', 'parquet'), default='csv')
+    export_parser.add_argument('--output', help='Output file, exported_data.<format> by default')
+    export_parser.add_argument('--incremental', action='store_true',
+                               help='Only export the rows changed since the last incremental export')
+    export_parser.add_argument('--batch-size', type=int, default=1000, help='Rows read from the database at once')
+    export_parser.set_defaults(func=export)
+
+    stats_parser = subparsers.add_parser('stats', help='Show database counts')
+    stats_parser.add_argument('--by', choices=('province', 'city', 'month'),
+                              help='Companies by province or city, or reviews by month')
+    stats_parser.add_argument('--province', help='Cities of this province only')
+    stats_parser.add_argument('--page', type=int, default=1)
+    stats_parser.add_argument('--page-size', type=int, default=20)
+    stats_parser.set_defaults(func=stats)
+
+    subparsers.add_parser('budget', help='Show the API cost of the month').set_defaults(func=budget)
+
+    serve_parser = subparsers.add_parser('serve', help='Serve the aggregates over HTTP')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.set_defaults(func=serve)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+import re
+import unicodedata
+from functools import lru_cache
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+# 7 characters are cells of about 150 x 150 meters
+GEOHASH_PRECISION = 7
+NON_ALPHANUMERIC = re.compile(r'[^a-z0-9]+')
+# Words that vary between listings of the same place
+STOPWORDS = frozenset(('de', 'del', 'la', 'las', 'el', 'los', 'y', 'sl', 'sa', 'slu'))
+
+
+@lru_cache(maxsize=65536)
+def normalize_name(name):
+    """ Lowercase name without accents, punctuation and stopwords: 'Residencia "Los Olivos", S.L.' -> 'residencia
+        olivos' """
+    name = unicodedata.normalize('NFKD', name or '').encode('ascii', 'ignore').decode('ascii').lower()
+    name = name.replace('.', '')
+    return ' '.join(word for word in NON_ALPHANUMERIC.split(name) if word and word not in STOPWORDS)
+
+
+def geohash(lat, lon, precision=GEOHASH_PRECISION):
+    """ Geohash of a point, nearby points share its prefixes """
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = bit_count = 0
+    even = True
+    while len(chars) < precision:
+        value, value_range = (lon, lon_range) if even else (lat, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = bit_count = 0
+    return ''.join(chars)
+
+
+def blocking_key(name, postal_code, cell):
+    """ Companies sharing this key are probably duplicate listings of the same place. None without a geohash cell. """
+    if cell is None:
+        return None
+    return f'{normalize_name(name)}|{postal_code or ""}|{cell}'
@@ -0,0 +1,165 @@
+import datetime
+import os
+import socket
+import time
+import uuid
+
+ITEM_COLUMNS = 'item_id, section_id, query, page, page_token, results'
+
+
+class CrawlQueue:
+    """ Persisted work queue of the text search crawl. A crawl job has one item per (section, query, page_token),
+        in state pending, in_flight, done or failed. Workers claim pending items with a lease, and each stored page
+        marks its item done and queues the next page in the same transaction, so a crawl stopped at any point
+        resumes from the last stored page.
+
+        Several processes sharing the database can work on the same job: an item whose worker died is claimed
+        again when its lease expires, and given up after max_attempts claims.
+    """
+
+    def __init__(self, conn, lock, lease_seconds=300, max_attempts=3):
+        self.conn = conn
+        self.lock = lock
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+    def running_job(self):
+        """ Returns the oldest unfinished job, or None """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT job_id FROM crawl_job WHERE state = 'running' ORDER BY job_id LIMIT 1"
+            ).fetchone()
+        return row[0] if row else None
+
+    def create_job(self, items, exclusive=False):
+        """ Creates a job with a pending item for the first page of each (section_id, query). An exclusive job is
+            only created if no job is running, otherwise the running job is returned. Returns (job_id, created) """
+        if not items:
+            return None, False
+
+        now = self._now()
+        with self.lock:
+            # The check and the insert are a single statement, so two workers starting at once share one job
+            inserted = self.conn.execute('''
+                INSERT INTO crawl_job (state, created_at) SELECT 'running', ?
+                WHERE NOT ? OR NOT EXISTS (SELECT 1 FROM crawl_job WHERE state = 'running')
+            ''', (now, exclusive))
+            if not inserted.rowcount:
+                self.conn.rollback()
+                return self.running_job(), False
+
+            job_id = inserted.lastrowid
+            self.conn.executemany('''
+                INSERT INTO crawl_item (job_id, section_id, query, page, state, updated_at)
+                VALUES (?, ?, ?, 0, 'pending', ?)
+            ''', [(job_id, section_id, query, now) for section_id, query in items])
+            self.conn.commit()
+        return job_id, True
+
+    def claim(self, job_id, limit):
+        """ Leases up to limit pending items of the job, or items whose lease expired, and returns them as dicts """
+        now = time.time()
+        lease_id = uuid.uuid4().hex
+        with self.lock:
+            # Items that keep killing their workers are given up
+            self.conn.execute('''
+                UPDATE crawl_item SET state = 'failed', error = 'Lease expired too many times', updated_at = ?
+                WHERE job_id = ? AND state = 'in_flight' AND lease_expires_at < ? AND attempts >= ?
+            ''', (self._now(), job_id, now, self.max_attempts))
+            self.conn.execute('''
+                UPDATE crawl_item SET state = 'in_flight', lease_owner = ?, lease_id = ?, lease_expires_at = ?,
+                attempts = attempts + 1, updated_at = ?
+                WHERE item_id IN (
+                    SELECT item_id FROM crawl_item
+                    WHERE job_id = ? AND (state = 'pending' OR (state = 'in_flight' AND lease_expires_at < ?))
+                    ORDER BY item_id LIMIT ?
+                )
+            ''', (self.owner, lease_id, now + self.lease_seconds, self._now(), job_id, now, limit))
+            self.conn.commit()
+
+            cursor = self.conn.execute(f'SELECT {ITEM_COLUMNS} FROM crawl_item WHERE lease_id = ?', (lease_id,))
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def checkpoint(self, item_id, results, next_page_token):
+        """ Marks a stored page done and leases the item of its next page to us. Runs in the caller's transaction,
+            so the page and the checkpoint are committed together. Returns the next item_id, or None when there is
+            no next page or our lease was lost to another worker. """
+        now = self._now()
+        with self.lock:
+            updated = self.conn.execute('''
+                UPDATE crawl_item SET state = 'done', results = ?, lease_expires_at = NULL, updated_at = ?
+                WHERE item_id = ? AND state = 'in_flight' AND lease_owner = ?
+            ''', (results, now, item_id, self.owner)).rowcount
+            if not updated or not next_page_token:
+                return None
+
+            return self.conn.execute('''
+                INSERT INTO crawl_item (job_id, section_id, query, page, page_token, results, state, lease_owner,
+                lease_expires_at, attempts, updated_at)
+                SELECT job_id, section_id, query, page + 1, ?, ?, 'in_flight', ?, ?, 1, ?
+                FROM crawl_item WHERE item_id = ?
+            ''', (next_page_token, results, self.owner, time.time() + self.lease_seconds, now,
+                  item_id)).lastrowid
+
+    def fail(self, item_id, error):
+        with self.lock:
+            self.conn.execute('''
+                UPDATE crawl_item SET state = 'failed', error = ?, lease_expires_at = NULL, updated_at = ?
+                WHERE item_id = ? AND state = 'in_flight' AND lease_owner = ?
+            ''', (str(error), self._now(), item_id, self.owner))
+            self.conn.commit()
+
+    def release(self):
+        """ Gives back our unfinished items, e.g. when the crawl stops on the monthly cost limit """
+        with self.lock:
+            self.conn.rollback()
+            self.conn.execute('''
+                UPDATE crawl_item SET state = 'pending', lease_owner = NULL, lease_expires_at = NULL,
+                attempts = attempts - 1, updated_at = ?
+                WHERE state = 'in_flight' AND lease_owner = ?
+            ''', (self._now(), self.owner))
+            self.conn.commit()
+
+    def finish_job(self, job_id):
+        """ Marks the job done once none of its items is left. Returns True to the single worker that finished it """
+        with self.lock:
+            finished = self.conn.execute('''
+                UPDATE crawl_job SET state = 'done', finished_at = ?
+                WHERE job_id = ? AND state = 'running' AND NOT EXISTS (
+                    SELECT 1 FROM crawl_item WHERE job_id = ? AND state IN ('pending', 'in_flight')
+                )
+            ''', (self._now(), job_id, job_id)).rowcount
+            self.conn.commit()
+        return finished > 0
+
+    def progress(self, job_id):
+        """ Returns {state: item count} of the job """
+        with self.lock:
+            rows = self.conn.execute('SELECT state, COUNT(*) FROM crawl_item WHERE job_id = ? GROUP BY state',
+                                     (job_id,)).fetchall()
+        return dict(rows)
+
+    def section_ids(self, job_id):
+        with self.lock:
+            rows = self.conn.execute('SELECT DISTINCT section_id FROM crawl_item WHERE job_id = ? ORDER BY section_id',
+                                     (job_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def saturated_section_ids(self, job_id, results_cap):
+        """ Sections where the last page of a query reached results_cap """
+        with self.lock:
+            rows = self.conn.execute('''
+                SELECT DISTINCT section_id FROM crawl_item i
+                WHERE job_id = ? AND state = 'done' AND results >= ? AND NOT EXISTS (
+                    SELECT 1 FROM crawl_item n
+                    WHERE n.job_id = i.job_id AND n.section_id = i.section_id AND n.query = i.query
+                    AND n.page = i.page + 1
+                )
+            ''', (job_id, results_cap)).fetchall()
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
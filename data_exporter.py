@@ -1,15 +1,9 @@
-import sqlite3
 import csv
-import configparser
 import json
+import os
+import sys
 
-# Config and db connection
-config = configparser.ConfigParser()
-config.read("config.ini")
-conn = sqlite3.connect(config['DEFAULT']['DatabasePath'])
-cursor = conn.cursor()
-
-# SQL query
+# SQL query, {where} is filled on incremental exports. Duplicate listings are not exported.
 query = """
     SELECT
     c.place_id as place,
@@ -19,25 +13,36 @@ query = """
     c.postal_code as cp,
     c.address as address,
     IFNULL(cd.website, "https://rankingresidencias.com/no-web") as web,
-    c.address || ', ' || c.state || ', ' || c.city || ', ' || c.postal_code as "dirección completa",
+    c.full_address as "dirección completa",
     cd.phone_number as teléfono,
     cd.total_reviews as reviews,
     cd.avg_reviews as media,
     cd.place_photo as foto,
+    cd.photo_file as "foto local",
     cd.updated_at,
     cd.opening_hours as horario,
-    cd.reviews as destacadas,
-    'https://www.google.com/search?q=' || REPLACE(REPLACE(name || ' ' || c.address, ' ', '+'), ',', '%2C') || '+opiniones' as "enlace a ficha google"
+    (
+        SELECT json_group_array(json_object(
+            'author_name', r.author_name, 'author_url', r.author_url, 'language', r.language,
+            'original_language', r.original_language, 'profile_photo_url', r.profile_photo_url,
+            'rating', r.rating, 'relative_time_description', r.relative_time_description, 'text', r.text,
+            'time', r.time, 'translated', CASE r.translated WHEN 1 THEN json('true') WHEN 0 THEN json('false') END
+        ))
+        FROM (SELECT * FROM review WHERE review.place_id = c.place_id ORDER BY time DESC LIMIT 5) r
+    ) as destacadas,
+    c.search_url as "enlace a ficha google",
+    MAX(IFNULL(c.updated_at, ''), IFNULL(cd.updated_at, '')) as changed_at
 FROM
     company c
 INNER JOIN
-    company_details cd ON cd.place_id = c.place_id;
+    company_details cd ON cd.place_id = c.place_id
+WHERE c.duplicate_of IS NULL {where}
 """
 
-cursor.execute(query)
-
-# Get data query
-rows = cursor.fetchall()
+FORMATS = ('csv', 'jsonl', 'parquet')
+# Columns holding escaped JSON strings, unescaped on export. The reviews are built unescaped by the query.
+JSON_COLUMNS = ('horario',)
+WATERMARK_PATH = 'export_watermark.json'
 
 
 def unescape_text(text):
@@ -45,23 +50,112 @@ def unescape_text(text):
         parsed_json = json.loads(text)
         unescaped_json = json.dumps(parsed_json, ensure_ascii=False)
         return unescaped_json
-    except json.JSONDecodeError:
+    except (json.JSONDecodeError, TypeError):
         return text
 
 
-# Unscape json strings
-unescaped_rows = []
-for row in rows:
-    unescaped_row = list(row)
-    unescaped_row[13] = unescape_text(unescaped_row[13])  # Horario
-    unescaped_row[14] = unescape_text(unescaped_row[14])  # Destacadas
-    unescaped_rows.append(unescaped_row)
+def iter_rows(cursor, batch_size):
+    """ Reads the query results batch_size rows at a time """
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def transform(rows, headers, watermark):
+    """ Unescapes the json columns and keeps track of the newest change in watermark['changed_at'] """
+    json_indexes = [headers.index(column) for column in JSON_COLUMNS]
+    changed_at_index = headers.index('changed_at')
+    for row in rows:
+        row = list(row)
+        for index in json_indexes:
+            row[index] = unescape_text(row[index])
+        watermark['changed_at'] = max(watermark['changed_at'] or '', row.pop(changed_at_index))
+        yield row
+
+
+def write_csv(output, headers, rows, batch_size):
+    # Export results into unescaped CSV UTF-8
+    with open(output, 'w', encoding='utf-8', newline='') as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(headers)  # write headers
+        for row in rows:
+            csvwriter.writerow(row)
+
+
+def write_jsonl(output, headers, rows, batch_size):
+    with open(output, 'w', encoding='utf-8') as jsonl_file:
+        for row in rows:
+            jsonl_file.write(json.dumps(dict(zip(headers, row)), ensure_ascii=False) + '\n')
+
+
+def write_parquet(output, headers, rows, batch_size):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit('Parquet export needs pyarrow, install it with: pip install pyarrow')
+
+    column_types = {'reviews': pa.int64(), 'media': pa.float64()}
+    schema = pa.schema([(header, column_types.get(header, pa.string())) for header in headers])
+
+    with pq.ParquetWriter(output, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                writer.write_batch(pa.RecordBatch.from_pylist([dict(zip(headers, row)) for row in batch], schema))
+                batch = []
+        if batch:
+            writer.write_batch(pa.RecordBatch.from_pylist([dict(zip(headers, row)) for row in batch], schema))
+
+
+WRITERS = {'csv': write_csv, 'jsonl': write_jsonl, 'parquet': write_parquet}
+
+
+def read_watermark(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as file:
+        return json.load(file).get('changed_at')
+
+
+def export(conn, output, export_format='csv', incremental=False, batch_size=1000, watermark_path=WATERMARK_PATH):
+    """ Streams the companies with details into output. Incremental exports only write the rows changed since the
+        last export, dates have a one day granularity so the rows of the watermark day are exported again.
+        Returns the number of exported rows. """
+    previous_watermark = read_watermark(watermark_path) if incremental else None
+
+    cursor = conn.cursor()
+    if previous_watermark:
+        cursor.execute(query.format(where='AND (c.updated_at >= ? OR cd.updated_at >= ?)'),
+                       (previous_watermark, previous_watermark))
+    else:
+        cursor.execute(query.format(where=''))
+
+    headers = [column[0] for column in cursor.description]
+    watermark = {'changed_at': previous_watermark}
+    exported_rows = 0
+
+    def counted(rows):
+        nonlocal exported_rows
+        for row in rows:
+            exported_rows += 1
+            yield row
+
+    rows = counted(transform(iter_rows(cursor, batch_size), headers, watermark))
+    WRITERS[export_format](output, headers[:-1], rows, batch_size)
+
+    if incremental and watermark['changed_at']:
+        with open(watermark_path, 'w') as file:
+            json.dump({'changed_at': watermark['changed_at']}, file)
+
+    return exported_rows
+
 
-# Export results into unescaped CSV UTF-8
-with open('exported_data.csv', 'w', encoding='utf-8', newline='') as csvfile:
-    csvwriter = csv.writer(csvfile)
-    csvwriter.writerow([i[0] for i in cursor.description])  # write headers
-    csvwriter.writerows(unescaped_rows)
+if __name__ == '__main__':
+    # Same as `cli.py export`, which migrates old databases and refuses a missing one
+    import cli
 
-# Close connection
-conn.close()
+    sys.exit(cli.main(['export'] + sys.argv[1:]))
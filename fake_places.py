@@ -0,0 +1,236 @@
+import base64
+import datetime
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from functools import lru_cache
+
+from request_executor import PlacesApiError
+from section_planner import EARTH_RADIUS, offset
+
+RESULTS_PER_PAGE = 20
+STREETS = ('Calle Mayor', 'Calle del Sol', 'Avenida de la Constitución', 'Calle Real', 'Plaza de España',
+           'Calle de la Iglesia', 'Paseo del Prado', 'Calle Nueva', 'Avenida de Andalucía', 'Calle San Juan')
+NAMES = ('Residencia', 'Centro de Día', 'Hogar', 'Residencia de Mayores', 'Apartamentos Tutelados')
+SURNAMES = ('San José', 'Los Olivos', 'El Pinar', 'Santa Ana', 'La Esperanza', 'Los Almendros', 'Virgen del Carmen',
+            'El Parque', 'Las Acacias', 'Nuestra Señora')
+WEEKDAYS = ('lunes', 'martes', 'miércoles', 'jueves', 'viernes', 'sábado', 'domingo')
+# Details fields of the field mask and the result key holding them
+DETAIL_KEYS = {'photo': 'photos'}
+REVIEWS_EPOCH = datetime.date(2020, 1, 1)
+
+
+class FakePlacesClient:
+    """ Deterministic offline Places backend with the interface of googlemaps.Client used by the manager (place
+        and places). Places are generated around the sections of sections.json, `density` places per
+        1000 inhabitants, and are the same on every run with the same seed.
+
+        It is also its own photo resolver (photo_url, download): photo URLs point to a placeholder host and the
+        downloads are a few deterministic PNG bytes.
+
+        It behaves like Google where the manager cares: text searches return pages of 20 results sorted by distance,
+        up to max_results, a next_page_token is rejected with INVALID_REQUEST during page_token_delay seconds,
+        details only hold the requested fields, and the review count of a place grows every day. A share of
+        duplicate_rate places are duplicate listings of the previous place, a few meters away. Each call takes
+        `latency` seconds (±50%) and fails with UNKNOWN_ERROR with probability error_rate.
+    """
+
+    def __init__(self, sections, seed=42, latency=0.0, error_rate=0.0, page_token_delay=2.0, density=1.0,
+                 max_results=60, query_match=0.5, duplicate_rate=0.0):
+        self.sections = list(sections.items())
+        self.seed = seed
+        self.latency = latency
+        self.error_rate = error_rate
+        self.page_token_delay = page_token_delay
+        self.density = density
+        self.max_results = max_results
+        self.query_match = query_match
+        self.duplicate_rate = duplicate_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {'place': 0, 'places': 0, 'photo_url': 0}
+        self.spreads = [self._spread(data['population']) for _, data in self.sections]
+
+    @classmethod
+    def from_config(cls, config):
+        """ Builds the backend from the [FAKE] section of config.ini """
+        fake_config = config['FAKE'] if config.has_section('FAKE') else config['DEFAULT']
+        with open(fake_config.get('SectionsPath', fallback='sections.json'), 'r') as file:
+            sections = json.load(file)
+        return cls(
+            sections,
+            seed=fake_config.getint('Seed', fallback=42),
+            latency=fake_config.getfloat('Latency', fallback=0.0),
+            error_rate=fake_config.getfloat('ErrorRate', fallback=0.0),
+            page_token_delay=fake_config.getfloat('PageTokenDelay', fallback=2.0),
+            density=fake_config.getfloat('Density', fallback=1.0),
+            max_results=fake_config.getint('MaxResults', fallback=60),
+            query_match=fake_config.getfloat('QueryMatch', fallback=0.5),
+            duplicate_rate=fake_config.getfloat('DuplicateRate', fallback=0.0),
+        )
+
+    def place(self, place_id, fields=None, language=None):
+        self._call('place')
+        place = self._place_by_id(place_id)
+        if place is None:
+            raise PlacesApiError('NOT_FOUND')
+
+        result = self._details(place)
+        if fields is not None:
+            keys = {DETAIL_KEYS.get(field, field) for field in fields}
+            result = {key: value for key, value in result.items() if key in keys}
+        return {'status': 'OK', 'result': result}
+
+    def places(self, query=None, location=None, radius=None, language=None, page_token=None):
+        self._call('places')
+        start = 0
+        if page_token:
+            query, location, radius, start, issued_at = json.loads(base64.urlsafe_b64decode(page_token))
+            if time.time() - issued_at < self.page_token_delay:
+                raise PlacesApiError('INVALID_REQUEST')
+
+        matches = self._search(query, location, float(radius))[:self.max_results]
+        response = {'status': 'OK', 'results': [self._search_result(place)
+                                                for place in matches[start:start + RESULTS_PER_PAGE]]}
+        if start + RESULTS_PER_PAGE < len(matches):
+            token = [query, location, radius, start + RESULTS_PER_PAGE, time.time()]
+            response['next_page_token'] = base64.urlsafe_b64encode(json.dumps(token).encode()).decode()
+        return response
+
+    def photo_url(self, photo_reference, max_width=None, max_height=None):
+        self._call('photo_url')
+        return f'https://fake-places.invalid/photo/{photo_reference}?maxwidth={max_width}&maxheight={max_height}'
+
+    def download(self, url, max_bytes):
+        content = b'\x89PNG fake photo ' + hashlib.sha256(url.split('?')[0].encode()).digest()
+        return content if len(content) <= max_bytes else None
+
+    def close(self):
+        pass
+
+    def iter_places(self):
+        """ Every generated place as a text search result, e.g. to fill a benchmark database """
+        for section_index in range(len(self.sections)):
+            for place in self._section_places(section_index):
+                yield self._search_result(place)
+
+    def _call(self, method):
+        with self.lock:
+            self.calls[method] += 1
+            jitter = self.rng.uniform(0.5, 1.5)
+            failed = self.rng.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency * jitter)
+        if failed:
+            raise PlacesApiError('UNKNOWN_ERROR')
+
+    @staticmethod
+    def _spread(population):
+        """ Meters around the section center where its places are """
+        return min(40000.0, max(3000.0, 20000 * math.sqrt(population / 1000000)))
+
+    @lru_cache(maxsize=64)
+    def _section_places(self, section_index):
+        name, data = self.sections[section_index]
+        rng = random.Random(f'{self.seed}-{section_index}')
+        places = []
+        for i in range(max(1, round(self.density * data['population'] / 1000))):
+            distance, angle = self.spreads[section_index] * math.sqrt(rng.random()), rng.random() * 2 * math.pi
+            lat, lon = offset(data['lat'], data['lon'], distance * math.cos(angle), distance * math.sin(angle))
+            address = (f'{rng.choice(STREETS)}, {rng.randint(1, 200)}, {rng.randint(1000, 52999):05d} {name}, '
+                       f'{name}, España')
+            if places and rng.random() < self.duplicate_rate:
+                duplicated = places[-1]
+                lat, lon = offset(duplicated['lat'], duplicated['lon'], rng.uniform(-5, 5), rng.uniform(-5, 5))
+                places.append(dict(duplicated, place_id=f'fake-{section_index}-{i}', lat=lat, lon=lon))
+                continue
+            places.append({
+                'place_id': f'fake-{section_index}-{i}',
+                'name': f'{rng.choice(NAMES)} {rng.choice(SURNAMES)}',
+                'lat': lat,
+                'lon': lon,
+                'formatted_address': address,
+            })
+        return places
+
+    def _place_by_id(self, place_id):
+        try:
+            _, section_index, index = place_id.split('-')
+            places = self._section_places(int(section_index))
+            return places[int(index)]
+        except (ValueError, IndexError):
+            return None
+
+    @lru_cache(maxsize=256)
+    def _search(self, query, location, radius):
+        """ Places of the query within radius of location, nearest first """
+        lat, lon = map(float, location.split(','))
+        meters_per_degree = math.radians(1) * EARTH_RADIUS
+        lon_scale = math.cos(math.radians(lat))
+
+        matches = []
+        for section_index, (_, data) in enumerate(self.sections):
+            # Equirectangular distances are precise enough at the scale of a search
+            center_distance = math.hypot((data['lat'] - lat) * meters_per_degree,
+                                         (data['lon'] - lon) * meters_per_degree * lon_scale)
+            if center_distance > radius + self.spreads[section_index]:
+                continue
+            for place in self._section_places(section_index):
+                distance = math.hypot((place['lat'] - lat) * meters_per_degree,
+                                      (place['lon'] - lon) * meters_per_degree * lon_scale)
+                if distance <= radius and self._matches(query, place['place_id']):
+                    matches.append((distance, place))
+
+        matches.sort(key=lambda match: match[0])
+        return tuple(place for _, place in matches)
+
+    def _matches(self, query, place_id):
+        return zlib.crc32(f'{query}|{place_id}'.encode()) % 1000 < self.query_match * 1000
+
+    @staticmethod
+    def _search_result(place):
+        return {
+            'place_id': place['place_id'],
+            'name': place['name'],
+            'formatted_address': place['formatted_address'],
+            'geometry': {'location': {'lat': place['lat'], 'lng': place['lon']}},
+        }
+
+    def _details(self, place):
+        rng = random.Random(f"{self.seed}-{place['place_id']}")
+        days = (datetime.date.today() - REVIEWS_EPOCH).days
+        # Reviews per day, the review count of a place grows every day
+        velocity = rng.choice((0.01, 0.02, 0.05, 0.1, 0.3))
+        base_reviews = rng.randint(0, 50)
+        total_reviews = base_reviews + int(velocity * days)
+        # The photo changes every photo_days days
+        photo_days = rng.randint(90, 720)
+        newest_review = time.mktime(REVIEWS_EPOCH.timetuple()) + days * 86400
+
+        return {
+            'place_id': place['place_id'],
+            'name': place['name'],
+            'website': f"https://{place['place_id']}.example.com" if rng.random() < 0.7 else None,
+            'formatted_phone_number': f'9{rng.randint(10000000, 99999999)}',
+            'rating': round(rng.uniform(2.5, 5), 1),
+            'user_ratings_total': total_reviews,
+            'reviews': [{
+                'author_name': f'Autor {total_reviews - i}',
+                'author_url': None,
+                'language': 'es',
+                'original_language': 'es',
+                'profile_photo_url': None,
+                'rating': 1 + zlib.crc32(f"{place['place_id']}|{total_reviews - i}".encode()) % 5,
+                'relative_time_description': f'hace {i + 1} días',
+                'text': f'Opinión {total_reviews - i}',
+                'time': int(newest_review - i * 86400 / max(velocity, 0.01)),
+                'translated': False,
+            } for i in range(min(5, total_reviews))],
+            'opening_hours': {'weekday_text': [f'{weekday}: 9:00–20:00' for weekday in WEEKDAYS]},
+            'photos': [{'photo_reference': f"photo-{place['place_id']}-{days // photo_days}", 'height': 1600,
+                        'width': 1600}],
+        }
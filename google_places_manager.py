@@ -1,23 +1,88 @@
+import atexit
+import functools
 import json
+import logging
+import logging.handlers
 import math
-import re
+import os
 import time
-import googlemaps
 import sqlite3
 import datetime
 import configparser
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import address_parser
+import company_dedup
+from api_cost_ledger import ApiCostLedger
+from crawl_queue import CrawlQueue
+from photo_store import PhotoDownloadError, PhotoStore
+from places_client import check_config, create_client, create_photo_resolver
+from pagination_scheduler import PageCursor, PageTokenNotReady, PaginationScheduler, is_page_token_not_ready
+from request_executor import BudgetExhaustedError, CircuitBreaker, PlacesRequestError, RequestExecutor
+from query_planner import QueryPlanner, QueryYields
+from response_cache import CacheMissError, ResponseCache
+from section_planner import RESULTS_CAP, SectionPlanner
+from refresh_planner import FIELD_GROUPS, GROUP_COLUMNS, RefreshPlanner, RefreshStats
+from run_metrics import RunMetrics
+
+
+class ConfigError(Exception):
+    """config.ini or the database are not ready to work with"""
+
+
+def metered_run(method):
+    """Records the metrics of a manager run and writes its report when the run ends, also on errors"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.metrics = RunMetrics(method.__name__)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.write_run_report()
+    return wrapper
 
 
 class GooglePlacesManager:
 
+    # Schema changes applied once on existing databases, in order. Append new ones, never edit the applied ones.
+    MIGRATIONS = (
+        (1, '_migration_section_crawl_columns'),
+        (2, '_migration_lookup_indexes'),
+        (3, '_migration_review_table'),
+        (4, '_migration_details_field_groups'),
+        (5, '_migration_crawl_queue'),
+        (6, '_migration_company_sections_and_dedup'),
+        (7, '_migration_photo_store'),
+        (8, '_migration_query_yield'),
+        (9, '_migration_read_aggregates'),
+        (10, '_migration_refresh_due_dates'),
+        (11, '_migration_section_searched_at'),
+    )
+    # Resolved photos written per transaction
+    PHOTO_BATCH_SIZE = 50
+    # Overdue companies read per company to refresh, the ones with the highest expected value of change are refreshed
+    REFRESH_CANDIDATES_PER_COMPANY = 4
+
     def __init__(self):
         """Constructor initializing the Google Maps client, SQLite database connection, and API consumption limits."""
         config = configparser.ConfigParser()
         config.read("config.ini")
+        self.metrics = RunMetrics()
 
         try:
-            self.gmaps = googlemaps.Client(key=config['DEFAULT']['GoogleApiKey'])
-            self.conn = sqlite3.connect(config['DEFAULT']['DatabasePath'])
+            self.config = config
+            self.response_cache = ResponseCache.from_config(config)
+            # Replay mode never reaches Google, so it works without a valid API key
+            if self.response_cache is None or not self.response_cache.replay:
+                check_config(config)
+            self._gmaps = None
+            self._photo_resolver = None
+            self._client_lock = threading.Lock()
+            self.photo_store = PhotoStore.from_config(config)
+            # The connection is shared by the details workers, every access goes through db_lock
+            self.conn = sqlite3.connect(config['DEFAULT']['DatabasePath'], check_same_thread=False)
+            self.db_lock = threading.RLock()
+            self._configure_connection(config['DEFAULT'])
             self.cursor = self.conn.cursor()
             self.max_monthly_cost = config['DEFAULT'].getfloat('MaxMonthlyCost')
             self.place_details_query_cost = config['DEFAULT'].getfloat('PlaceDetailsQueryCost')
@@ -25,47 +90,158 @@ class GooglePlacesManager:
             self.place_photo_query_cost = config['DEFAULT'].getfloat('PlacePhotoQueryCost')
             self.current_company_queries = config['QUERIES']['CompanyQueries'].split(', ')
             self.debug_mode = config['DEFAULT']['DEBUG'] == '1'
+            self.logger = self._create_logger() if self.debug_mode else None
+            self.run_report_path = config['DEFAULT'].get('RunReportPath', fallback='log/run_report.jsonl')
+            self.prometheus_textfile_path = config['DEFAULT'].get('PrometheusTextfilePath', fallback='')
+            self.details_workers = max(1, config['DEFAULT'].getint('DetailsWorkers', fallback=1))
+            self.search_workers = max(1, config['DEFAULT'].getint('SearchWorkers', fallback=1))
+            self.page_token_delay = config['DEFAULT'].getfloat('PageTokenDelay', fallback=2)
             self.default_query_cost = 1
-            self._create_tables()
-            self.current_company_details = None
+            self.search_radius = config['DEFAULT'].getfloat('SearchRadius', fallback=50000)
+            self.section_planner = SectionPlanner(
+                self.current_company_queries, self.place_search_query_cost,
+                skip_ratio=config['DEFAULT'].getfloat('CoverageSkipRatio', fallback=0.9),
+                min_radius=config['DEFAULT'].getfloat('MinSectionRadius', fallback=2000)
+            )
+            self.coverage_max_age_days = config['DEFAULT'].getint('CoverageMaxAgeDays', fallback=30)
+            self.query_planner = QueryPlanner(
+                self.place_search_query_cost,
+                min_page_yield=config['DEFAULT'].getfloat('MinPageYield', fallback=0.1),
+                min_query_yield=config['DEFAULT'].getfloat('MinQueryYield', fallback=0.5)
+            )
+            self.query_yield_max_age_days = config['DEFAULT'].getint('QueryYieldMaxAgeDays', fallback=180)
+            # 0: a crawl job may spend the whole monthly budget left
+            self.crawl_job_max_cost = config['DEFAULT'].getfloat('CrawlJobMaxCost', fallback=0)
+            # Without PlaceDetailsBaseCost every details request costs PlaceDetailsQueryCost, whatever its fields
+            self.refresh_planner = RefreshPlanner(
+                {group: config['DEFAULT'].getint(f'{group.capitalize()}RefreshDays', fallback=None)
+                 for group in FIELD_GROUPS},
+                config['DEFAULT'].getfloat('PlaceDetailsBaseCost', fallback=self.place_details_query_cost),
+                {
+                    'contact': config['DEFAULT'].getfloat('PlaceDetailsContactCost', fallback=0),
+                    'atmosphere': config['DEFAULT'].getfloat('PlaceDetailsAtmosphereCost', fallback=0),
+                },
+                self.place_photo_query_cost
+            )
+            self._ensure_schema()
+            self.cost_ledger = ApiCostLedger(
+                self.conn, self.db_lock, self.max_monthly_cost,
+                chunk_size=config['DEFAULT'].getfloat('BudgetChunk', fallback=0.5),
+                flush_every=config['DEFAULT'].getint('CostFlushEvery', fallback=20)
+            )
+            self.request_executor = RequestExecutor(
+                self._charge_request, self._refund_request,
+                rates={
+                    'place_details': config['DEFAULT'].getfloat('PlaceDetailsQps', fallback=10),
+                    'text_search': config['DEFAULT'].getfloat('TextSearchQps', fallback=10),
+                    'place_photo': config['DEFAULT'].getfloat('PlacePhotoQps', fallback=10),
+                },
+                max_retries=config['DEFAULT'].getint('MaxRetries', fallback=3),
+                base_delay=config['DEFAULT'].getfloat('RetryBaseDelay', fallback=1),
+                max_delay=config['DEFAULT'].getfloat('RetryMaxDelay', fallback=30),
+                breaker=CircuitBreaker(config['DEFAULT'].getint('CircuitBreakerFailures', fallback=5),
+                                       config['DEFAULT'].getfloat('CircuitBreakerResetSeconds', fallback=60)),
+                passthrough_errors=(PageTokenNotReady,),
+                observe=self._observe_request
+            )
+            self.crawl_queue = CrawlQueue(
+                self.conn, self.db_lock,
+                lease_seconds=config['DEFAULT'].getfloat('CrawlLeaseSeconds', fallback=300),
+                max_attempts=config['DEFAULT'].getint('CrawlMaxAttempts', fallback=3)
+            )
+            # Scripts don't always close the connection, make sure the spend is flushed and the budget released
+            atexit.register(self.close_connection)
         except Exception as e:
-            self.error('Please complete your config.ini #Error: ' + repr(e), True)
-
-    def error(self, msg, do_exit=False):
-        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            self.error('Please complete your config.ini #Error: ' + repr(e))
+            raise ConfigError(f'Invalid config.ini: {e!r}') from e
+
+    @property
+    def gmaps(self):
+        """Places backend: Google, or the offline fake backend for tests and benchmarks. Created on the first
+        request, so runs that never reach the API don't pay for importing googlemaps and requests."""
+        if self._gmaps is None and (self.response_cache is None or not self.response_cache.replay):
+            with self._client_lock:
+                if self._gmaps is None:
+                    self._gmaps = create_client(self.config)
+        return self._gmaps
+
+    @property
+    def photo_resolver(self):
+        """Resolves the photo references into image URLs, sharing its HTTP connections between the workers"""
+        if self._photo_resolver is None:
+            client = self.gmaps
+            with self._client_lock:
+                if self._photo_resolver is None:
+                    self._photo_resolver = create_photo_resolver(self.config, client)
+        return self._photo_resolver
+
+    def _configure_connection(self, config):
+        """WAL lets readers (e.g. the exporter) work while we write and makes commits much cheaper"""
+        synchronous = config.get('SqliteSynchronous', fallback='NORMAL').upper()
+        if synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise ValueError(f'Invalid SqliteSynchronous value {synchronous}')
+
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute(f'PRAGMA synchronous = {synchronous}')
+        # Negative cache_size is expressed in KiB
+        self.conn.execute(f"PRAGMA cache_size = -{config.getint('SqliteCacheSizeKb', fallback=20000)}")
+
+    def error(self, msg):
         print(msg)
 
         ''' Writes in the log file the actual hour and date with the error messagge if debug mode is enabled. '''
-        if self.debug_mode:
-            with open('log/debug.log', 'a') as log_file:
-                log_file.write(f'[{timestamp}] ERROR: {msg}\n')
-
-        if do_exit:
-            exit(0)
-
-    def _register_api_cost(self, cost):
-        """Registers the cost of API calls and checks if it exceeds the monthly limit."""
-        year, month = datetime.date.today().year, datetime.date.today().month
-
-        # Update or insert the cost
-        self.cursor.execute('SELECT cost, query_count FROM api_costs WHERE year = ? AND month = ?', (year, month))
-        result = self.cursor.fetchone()
-
-        if result:
-            total_cost = round(result[0] + cost, 6)
-            query_count = result[1] + 1
-            if total_cost > self.max_monthly_cost:
-                return False
-            self.cursor.execute('UPDATE api_costs SET cost = ?, query_count = ? WHERE year = ? AND month = ?',
-                                (total_cost, query_count, year, month))
-        else:
-            if cost > self.max_monthly_cost:
-                return False
-            self.cursor.execute('INSERT INTO api_costs (year, month, cost, query_count) VALUES (?, ?, ?, ?)',
-                                (year, month, cost, 1))
+        if getattr(self, 'logger', None) is not None:
+            self.logger.error(msg)
 
-        self.conn.commit()
-        return True
+    @staticmethod
+    def _create_logger():
+        """Debug logger of log/debug.log. Messages are buffered and written in batches, and always when the
+        connection is closed, instead of opening the file on every error."""
+        logger = logging.getLogger('google_places_manager')
+        if not logger.handlers:
+            os.makedirs('log', exist_ok=True)
+            file_handler = logging.FileHandler('log/debug.log', encoding='utf-8')
+            file_handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s',
+                                                        '%Y-%m-%d %H:%M:%S'))
+            logger.addHandler(logging.handlers.MemoryHandler(100, flushLevel=logging.CRITICAL, target=file_handler))
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+        return logger
+
+    def _observe_request(self, request_type, seconds, attempts, failed):
+        self.metrics.observe_request(request_type, seconds, attempts, failed)
+
+    def write_run_report(self):
+        """Appends the metrics of the run to RunReportPath and writes them to PrometheusTextfilePath if set"""
+        metrics, self.metrics = self.metrics, RunMetrics()
+        report = metrics.report()
+        if self.run_report_path:
+            metrics.write_jsonl(self.run_report_path)
+        if self.prometheus_textfile_path:
+            metrics.write_prometheus(self.prometheus_textfile_path)
+
+        requests = ', '.join(f"{request_type}: {summary['count']} (p95 {summary['p95']}s, {summary['retries']} "
+                             f"retries, {summary['errors']} errors)"
+                             for request_type, summary in report['requests'].items())
+        print(f"Run {report['run']} took {report['duration']}s and cost ${report['cost']:.3f}. "
+              f"Requests: {requests or 'none'}")
+
+    def _register_api_cost(self, request_type, cost):
+        """Registers the cost of API calls and checks if it exceeds the monthly limit.
+        Budget is reserved atomically by the cost ledger, so concurrent workers and processes can't overspend."""
+        return self.cost_ledger.register(request_type, cost)
+
+    def _charge_request(self, request_type, cost=None):
+        cost = cost if cost is not None else self.get_query_cost_by_type(request_type)
+        charged = self._register_api_cost(request_type, cost)
+        if charged:
+            self.metrics.add_cost(request_type, cost)
+        return charged
+
+    def _refund_request(self, request_type, cost=None):
+        cost = cost if cost is not None else self.get_query_cost_by_type(request_type)
+        self.cost_ledger.refund(request_type, cost)
+        self.metrics.add_cost(request_type, -cost)
 
     def get_query_cost_by_type(self, query_type):
         """ Calculates the cost of API queries based on the type of query assuming all queries are Preferred
@@ -82,110 +258,364 @@ class GooglePlacesManager:
         else:
             return self.default_query_cost
 
-    def google_places_request(self, request_type, query_model, params, tries=0):
-        """Check if we have monthly cost available before performing the query"""
-        if 'page_token' in params:
-            time.sleep(2)
-        try:
-            cost = self.get_query_cost_by_type(request_type)
-            if not self._register_api_cost(cost):
-                self.error('Monthly API cost limit reached. Exiting', True)
-            if query_model == 'place':
-                return self.gmaps.place(**params)
-            elif query_model == 'places':
-                return self.gmaps.places(**params)
-            elif query_model == 'photo':
-                if 'photo_reference' in params:
-                    return self.gmaps.places_photo(**params)
-                self.error('Missing photo reference for photos request. Exiting.', True)
-
-            self.error('The query model is invalid. Exiting', True)
-        except Exception as e:
-            time.sleep(10)
-            if tries < 1:
-                self.google_places_request(request_type, query_model, params, tries=tries + 1)
-                self.error('The query returned an error' + repr(e), True)
+    def google_places_request(self, request_type, query_model, params, cost=None):
+        """Serves the request from the response cache when possible, otherwise sends it through the request
+        executor, which checks if we have monthly cost available before performing the query and retries
+        transient errors. Raises PlacesRequestError when the request finally fails, and BudgetExhaustedError
+        when the monthly cost limit is reached. cost overrides the cost of the request type, e.g. for place
+        details with a field mask."""
+        return self._places_request(request_type, query_model, params, cost)[0]
+
+    def _places_request(self, request_type, query_model, params, cost=None):
+        """google_places_request, returns (response, billed), billed being False when served from the cache"""
+        cacheable = self.response_cache is not None and query_model != 'photo'
+        if cacheable:
+            cached_response = self.response_cache.get(request_type, params)
+            if cached_response is not None:
+                return cached_response, False
+        if self.response_cache is not None and self.response_cache.replay:
+            raise CacheMissError(f'No cached {request_type} response for {params}')
+
+        if query_model not in ('place', 'places', 'photo'):
+            raise ValueError(f'The query model {query_model} is invalid')
+        if query_model == 'photo' and 'photo_reference' not in params:
+            raise ValueError('Missing photo reference for photos request')
+
+        def send():
+            try:
+                if query_model == 'place':
+                    return self.gmaps.place(**params)
+                elif query_model == 'places':
+                    return self.gmaps.places(**params)
+                return self.photo_resolver.photo_url(**params)
+            except Exception as e:
+                if is_page_token_not_ready(e, params):
+                    # Not billed, the pagination scheduler retries it after a short backoff
+                    raise PageTokenNotReady(repr(e)) from e
+                raise
 
+        try:
+            response = self.request_executor.execute(request_type, send, cost)
+        except BudgetExhaustedError:
+            self.error('Monthly API cost limit reached')
+            raise
+
+        if isinstance(response, dict):
+            self.metrics.add_bytes(request_type, len(json.dumps(response)))
+        if cacheable:
+            self.response_cache.set(request_type, params, response)
+        return response, True
+
+    @metered_run
     def update_company_details(self, frequency_days_to_update, limit=200):
-        """Updates the details of the companies stored in the database not updated in the last
-        frequency_days_to_update"""
-        self.cursor.execute('''
-            SELECT place_id, name FROM company 
-            WHERE (julianday(?) - julianday(detail_updated_at)) > (?) OR detail_updated_at IS NULL
-            ORDER BY section_id ASC LIMIT ?          
-            ''', (datetime.date.today(), frequency_days_to_update, limit)
-                            )
-        companies_to_update = self.cursor.fetchall()
-        print(f"Updating {len(companies_to_update)} company details...")
-
-        for company in companies_to_update:
-            print(f"Updating {company[1]} ...")
-            place_id = company[0]
-            params = {
-                'place_id': place_id,
-                'fields': ['website', 'formatted_phone_number', 'rating', 'reviews', 'user_ratings_total', 'opening_hours', 'photo'],
-                'language': 'es'
-            }
-            self.current_company_details = self.google_places_request('place_details', 'place', params)
-
-            website = self.current_company_details['result'].get('website')
-            phone_number = self.current_company_details['result'].get('formatted_phone_number')
-            avg_reviews = self.current_company_details['result'].get('rating')
-            all_reviews_json = self.get_all_reviews_json()
-            total_reviews = self.current_company_details['result'].get('user_ratings_total')
-            opening_hours = self.get_opening_hours_json()
-            photo = self.get_company_photo()
-
+        """Updates the stale details of the companies stored in the database. Each group of fields (contact,
+        atmosphere, hours, photo) is refreshed after its own <Group>RefreshDays, or frequency_days_to_update if not
+        configured, and only the stale groups are requested. Companies without details come first, then the ones
+        which probably got the most reviews since their last refresh. Duplicate listings are not refreshed.
+        Details are fetched by DetailsWorkers threads while this thread is the only one writing the results, the
+        changed photos are resolved afterwards in one batch, see resolve_pending_photos."""
+        today = datetime.date.today()
+        schedule = self.refresh_planner.schedule(frequency_days_to_update)
+        cutoffs = self.refresh_planner.cutoffs(today, frequency_days_to_update)
+        self._update_refresh_due_dates(schedule)
+        # The most overdue companies are read through idx_company_refresh_due, only they are ranked
+        with self.db_lock, self.metrics.timed_sql('select_stale_details'):
             self.cursor.execute('''
-                INSERT INTO company_details 
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(place_id) DO 
-                UPDATE SET website = ?, phone_number = ?, total_reviews = ?, avg_reviews = ?, reviews = ?
-                , opening_hours = ?, place_photo = ?, updated_at = ?                
-            ''', (
-                place_id, website, phone_number, total_reviews, avg_reviews, all_reviews_json, opening_hours, photo,
-                datetime.date.today().strftime('%Y-%m-%d'), website, phone_number, total_reviews, avg_reviews,
-                all_reviews_json, opening_hours, photo, datetime.date.today().strftime('%Y-%m-%d')
-            )
+                SELECT c.place_id, c.name, c.detail_updated_at, cd.place_id IS NOT NULL AS has_details,
+                cd.contact_updated_at, cd.atmosphere_updated_at, cd.hours_updated_at, cd.photo_updated_at,
+                cd.total_reviews, cd.review_velocity, cd.photo_reference, cd.place_photo, cd.photo_file
+                FROM company c
+                LEFT JOIN company_details cd ON cd.place_id = c.place_id
+                WHERE c.duplicate_of IS NULL AND c.refresh_due_at < :today
+                ORDER BY c.refresh_due_at
+                LIMIT :candidates
+                ''', {'today': today.strftime('%Y-%m-%d'), 'candidates': limit * self.REFRESH_CANDIDATES_PER_COMPANY}
                                 )
+            columns = [column[0] for column in self.cursor.description]
+            candidates = [dict(zip(columns, row)) for row in self.cursor.fetchall()]
+        companies_to_update = self.refresh_planner.rank(candidates, today, limit)
+        print(f"Updating {len(companies_to_update)} company details...")
 
-            self.cursor.execute("UPDATE company SET detail_updated_at = ? WHERE place_id = ?"
-                                , (datetime.date.today().strftime('%Y-%m-%d'), place_id))
+        refresh_stats = RefreshStats()
+        try:
+            retry_queue = self._refresh_companies(companies_to_update, cutoffs, schedule, refresh_stats)
+            if retry_queue:
+                # Give Google some rest if the circuit breaker opened before retrying the failed companies
+                time.sleep(self.request_executor.breaker.cooldown_remaining())
+                print(f"Retrying {len(retry_queue)} company details...")
+                retry_queue = self._refresh_companies(retry_queue, cutoffs, schedule, refresh_stats)
+        except Exception:
+            # The details stored before the error are paid, resolve their photos while the budget allows
+            try:
+                self.resolve_pending_photos(limit, refresh_stats)
+            except Exception as e:
+                self.error(f"Could not resolve the photos of the stored details: {e!r}")
+            print(refresh_stats.report())
+            raise
+        for company in retry_queue:
+            self.error(f"Could not update the details of {company['name']} ({company['place_id']})")
+
+        self.resolve_pending_photos(limit, refresh_stats)
+        print(refresh_stats.report())
+
+    def _refresh_companies(self, companies, cutoffs, schedule, refresh_stats):
+        """Fetches and stores the details of companies, returns the ones that failed with a retryable error.
+        When a worker fails with a fatal error (cost limit reached, unexpected error) the queued companies are not
+        started, the running ones finish and every fetched details is stored, since it is paid, before the error is
+        raised."""
+        retry_queue = []
+
+        def store(future):
+            """Stores the details of a finished future, returns its error when it is fatal"""
+            try:
+                details = future.result()
+            except PlacesRequestError as e:
+                self.error(f"Error updating {futures[future]['name']}: {e}")
+                if e.retryable:
+                    retry_queue.append(futures[future])
+                return None
+            except Exception as e:
+                return e
+            if details is not None:
+                self.store_company_details(details, schedule)
+                refresh_stats.add(details)
+            return None
+
+        with ThreadPoolExecutor(max_workers=self.details_workers) as executor:
+            futures = {executor.submit(self.fetch_company_details, company, cutoffs): company
+                       for company in companies}
+            pending = set(futures)
+            try:
+                for future in as_completed(futures):
+                    pending.discard(future)
+                    fatal_error = store(future)
+                    if fatal_error is not None:
+                        break
+                else:
+                    return retry_queue
+
+                # Cancelled futures never complete for as_completed, only wait for the running ones
+                executor.shutdown(wait=False, cancel_futures=True)
+                for future in as_completed([future for future in pending if not future.cancelled()]):
+                    store(future)
+            except BaseException:
+                # Interrupted or the details could not be stored: don't start the queued companies
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        raise fatal_error
+
+    def fetch_company_details(self, company, cutoffs):
+        """Worker: requests the stale details of a company, returns the row to store"""
+        print(f"Updating {company['name']} ...")
+        groups = self.refresh_planner.stale_groups(company, cutoffs)
+        details_cost = self.refresh_planner.details_cost(groups)
+        params = {
+            'place_id': company['place_id'],
+            'fields': self.refresh_planner.field_mask(groups),
+            'language': 'es'
+        }
+        try:
+            company_details, billed = self._places_request('place_details', 'place', params, details_cost)
+        except CacheMissError as e:
+            self.error(f"Skipping {company['name']}: {e}")
+            return None
+
+        result = company_details['result']
+        details = {'place_id': company['place_id'], 'groups': groups, 'cost': details_cost, 'billed': billed}
+        if 'contact' in groups:
+            details.update({
+                'website': result.get('website'),
+                'phone_number': result.get('formatted_phone_number'),
+            })
+        if 'atmosphere' in groups:
+            details.update({
+                'avg_reviews': result.get('rating'),
+                'reviews': self.get_reviews(company_details),
+                'total_reviews': result.get('user_ratings_total'),
+                'review_velocity': self.refresh_planner.review_velocity(
+                    company, result.get('user_ratings_total'), datetime.date.today()
+                ),
+            })
+        if 'hours' in groups:
+            details['opening_hours'] = self.get_opening_hours_json(company_details)
+        if 'photo' in groups:
+            photo_reference = result['photos'][0].get('photo_reference') if result.get('photos') else None
+            if photo_reference and photo_reference == company['photo_reference'] and company['place_photo']:
+                # Same photo as last time, don't pay for it again
+                details['place_photo'] = company['place_photo']
+                details['photo_file'] = company['photo_file']
+                details['photo_unchanged'] = True
+            else:
+                # A NULL place_photo with a reference is resolved by resolve_pending_photos
+                details['place_photo'] = None if photo_reference else ''
+                details['photo_file'] = None
+            details['photo_reference'] = photo_reference
+
+        return details
+
+    def _update_refresh_due_dates(self, schedule):
+        """Recomputes the refresh due date of every company when the refresh schedule (<Group>RefreshDays or the
+        refresh frequency) changed since the last refresh. It is a full scan, store_company_details keeps the dates
+        up to date otherwise."""
+        with self.db_lock:
+            stored = self.cursor.execute('SELECT schedule FROM refresh_schedule').fetchone()
+            if stored is not None and json.loads(stored[0]) == schedule:
+                return
+            print('The refresh schedule changed, updating the refresh due dates of the companies...')
+            with self.metrics.timed_sql('update_refresh_due_dates'):
+                self.cursor.execute(f'''
+                    UPDATE company SET refresh_due_at = IFNULL((
+                        SELECT {self.refresh_planner.due_date_sql(schedule)} FROM company_details cd
+                        WHERE cd.place_id = company.place_id
+                    ), '')
+                ''')
+                self.cursor.execute('INSERT OR REPLACE INTO refresh_schedule (id, schedule) VALUES (1, ?)',
+                                    (json.dumps(schedule),))
+                self.conn.commit()
+
+    def store_company_details(self, details, schedule):
+        """Writer: persists the field groups fetched by fetch_company_details, the other ones are left as they are,
+        and the date the company is due for its next refresh under schedule"""
+        today_str = datetime.date.today().strftime('%Y-%m-%d')
+
+        values = {'place_id': details['place_id'], 'updated_at': today_str}
+        for group in details['groups']:
+            values.update({column: details[column] for column in GROUP_COLUMNS[group]})
+            values[f'{group}_updated_at'] = today_str
+
+        reviews = details['reviews'] if 'atmosphere' in details['groups'] else []
+        with self.db_lock, self.metrics.timed_sql('store_company_details', 1 + len(reviews)):
+            # Reviews are stored in the review table, the reviews column is kept for old databases
+            self.cursor.execute(f'''
+                INSERT INTO company_details ({', '.join(values)})
+                VALUES ({', '.join(f':{column}' for column in values)}) ON CONFLICT(place_id) DO
+                UPDATE SET {', '.join(f'{column} = excluded.{column}' for column in values if column != 'place_id')}
+            ''', values)
+            if reviews:
+                self.store_reviews(details['place_id'], reviews, today_str)
+
+            self.cursor.execute(f'''
+                UPDATE company SET detail_updated_at = ?, refresh_due_at = (
+                    SELECT {self.refresh_planner.due_date_sql(schedule)} FROM company_details cd
+                    WHERE cd.place_id = company.place_id
+                ) WHERE place_id = ?
+            ''', (today_str, details['place_id']))
 
             self.conn.commit()
 
-    def get_company_photo(self):
-        """ Get first company photo from company using google place photos API request """
+    def store_reviews(self, place_id, reviews, today_str):
+        """Upserts the reviews of a company, only the new and changed ones are written. Reviews accumulate across
+        refreshes while the API only returns 5 of them."""
+        self.cursor.executemany('''
+            INSERT INTO review (place_id, author_name, time, author_url, language, original_language,
+            profile_photo_url, rating, relative_time_description, text, translated, first_seen_at, updated_at)
+            VALUES (:place_id, :author_name, :time, :author_url, :language, :original_language, :profile_photo_url,
+            :rating, :relative_time_description, :text, :translated, :today, :today)
+            ON CONFLICT(place_id, author_name, time) DO UPDATE SET
+            author_url = excluded.author_url, language = excluded.language,
+            original_language = excluded.original_language, profile_photo_url = excluded.profile_photo_url,
+            rating = excluded.rating, relative_time_description = excluded.relative_time_description,
+            text = excluded.text, translated = excluded.translated, updated_at = excluded.updated_at
+            WHERE rating IS NOT excluded.rating OR text IS NOT excluded.text OR language IS NOT excluded.language
+            OR translated IS NOT excluded.translated OR profile_photo_url IS NOT excluded.profile_photo_url
+        ''', [dict(review, place_id=place_id, today=today_str) for review in reviews])
+
+    def resolve_pending_photos(self, limit, refresh_stats):
+        """Resolves the URLs of the photos changed since their last refresh, the most recently refreshed first, up
+        to limit. DetailsWorkers threads share the pooled connections of the photo resolver, and download the
+        photos into the photo store when PhotoStorePath is set. Results are written in batches by this thread.
+        Photos that failed with a retryable error stay pending for the next run."""
+        if self.response_cache is not None and self.response_cache.replay:
+            # Photo URLs expire, they are never cached
+            return
 
-        if 'photos' in self.current_company_details['result']:
-            try:
-                params = {
-                    'photo_reference': self.current_company_details['result']['photos'][0].get('photo_reference'),
-                    'max_height': 1600,
-                    'max_width': 1600
-                }
-                place_photo = self.google_places_request('place_photo', 'photo', params)
-                return place_photo.gi_frame.f_locals['self'].request.url
-            except Exception:
-                return ''
+        with self.db_lock, self.metrics.timed_sql('select_pending_photos'):
+            pending_photos = self.cursor.execute('''
+                SELECT place_id, photo_reference FROM company_details
+                WHERE place_photo IS NULL AND photo_reference IS NOT NULL
+                ORDER BY photo_updated_at DESC
+                LIMIT ?
+            ''', (limit,)).fetchall()
+        if not pending_photos:
+            return
+        print(f"Resolving {len(pending_photos)} company photos...")
 
-        return ''
+        photos = []
+        with ThreadPoolExecutor(max_workers=self.details_workers) as executor:
+            futures = {executor.submit(self.fetch_company_photo, photo_reference): (place_id, photo_reference)
+                       for place_id, photo_reference in pending_photos}
+            try:
+                for future in as_completed(futures):
+                    place_id, photo_reference = futures[future]
+                    try:
+                        place_photo, photo_file = future.result()
+                    except PlacesRequestError as e:
+                        self.error(f"Error resolving the photo of {place_id}: {e}")
+                        if e.retryable:
+                            continue
+                        # Google rejected the reference, it is requested again when the photo changes
+                        place_photo, photo_file = '', None
+                    else:
+                        refresh_stats.add_photo(self.refresh_planner.photo_cost, photo_file)
+                    photos.append({'place_id': place_id, 'photo_reference': photo_reference,
+                                   'place_photo': place_photo, 'photo_file': photo_file})
+                    if len(photos) == self.PHOTO_BATCH_SIZE:
+                        self.store_company_photos(photos)
+                        photos = []
+            except BaseException:
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+            finally:
+                # The photos resolved before the cost limit or an error are paid, keep them
+                self.store_company_photos(photos)
+
+    def fetch_company_photo(self, photo_reference):
+        """Worker: resolves the URL of a photo reference and stores the photo, returns (URL, stored file)"""
+        params = {
+            'photo_reference': photo_reference,
+            'max_height': 1600,
+            'max_width': 1600
+        }
+        place_photo = self.google_places_request('place_photo', 'photo', params)
+        if self.photo_store is None:
+            return place_photo, None
+        try:
+            content = self.photo_resolver.download(place_photo, self.photo_store.max_file_bytes)
+        except PhotoDownloadError as e:
+            self.error(str(e))
+            return place_photo, None
+        return place_photo, self.photo_store.put(content)
+
+    def store_company_photos(self, photos):
+        """Writer: stores resolved photos, unless the company got another photo meanwhile"""
+        if not photos:
+            return
+        with self.db_lock, self.metrics.timed_sql('store_company_photos', len(photos)):
+            self.cursor.executemany('''
+                UPDATE company_details SET place_photo = :place_photo, photo_file = :photo_file
+                WHERE place_id = :place_id AND photo_reference = :photo_reference
+            ''', photos)
+            self.conn.commit()
 
-    def get_opening_hours_json(self):
+    @staticmethod
+    def get_opening_hours_json(company_details):
         weekday_text = []
 
-        if 'opening_hours' in self.current_company_details['result']:
-            opening_hours = self.current_company_details['result'].get('opening_hours')
+        if 'opening_hours' in company_details['result']:
+            opening_hours = company_details['result'].get('opening_hours')
             if 'weekday_text' in opening_hours:
                 weekday_text = opening_hours['weekday_text']
 
         return json.dumps(weekday_text)
 
-    def get_all_reviews_json(self):
+    @staticmethod
+    def get_reviews(company_details):
         """ We can only get 5 reviews per query to API, pagination token can be adquired """
         all_reviews_data = []
 
-        if 'reviews' in self.current_company_details['result']:
-            reviews = self.current_company_details['result']['reviews']
+        if 'reviews' in company_details['result']:
+            reviews = company_details['result']['reviews']
             for review in reviews:
                 review_dict = {
                     'author_name': review.get('author_name'),
@@ -202,188 +632,401 @@ class GooglePlacesManager:
 
                 all_reviews_data.append(review_dict)
 
-        return json.dumps(all_reviews_data)
-
-    def search_and_store_companies(self, lat, lon, section_id, population):
-        """Searches for companies in the vicinity and stores them in the database."""
-        if len(self.current_company_queries) == 0:
-            self.error('There are no queries to get companies, please review your config.ini', True)
+        return all_reviews_data
+
+    def search_and_store_companies(self, section_id):
+        """Searches for companies in the vicinity of a stored section and stores them in the database. The crawl job
+        reads the coordinates and population of the section from the database, also when it is resumed."""
+        self.search_and_store_sections([self.get_section((section_id,))])
+
+    @metered_run
+    def search_and_store_sections(self, sections):
+        """Searches for companies of every section and its best queries as a new crawl job."""
+        planned, _ = self.plan_section_queries(sections)
+        job_id, _ = self.crawl_queue.create_job([(section_id, query) for section_id, query, _ in planned])
+        if job_id is not None:
+            self.run_crawl_job(job_id)
+
+    def run_crawl_job(self, job_id):
+        """Claims and crawls the pages of a job until none is left: while the next page token of a query is not
+        valid yet, the pages of other queries are requested. Every stored page is checkpointed, so the job resumes
+        where it stopped if the process dies, and several processes can crawl the same job. The worker finishing
+        the job marks its sections crawled and splits the ones where a query hit the results cap."""
+        max_companies_per_section = 1000  # Update as desired
+        companies_per_page = 20  # Assuming Google Place API returns 20 results per request
+
+        scheduler = PaginationScheduler(
+            self.fetch_search_page, self.store_search_page, workers=self.search_workers,
+            max_pages=math.ceil(max_companies_per_section / companies_per_page),
+            token_delay=self.page_token_delay, error=self.error, drop_page=self.drop_search_page,
+            fatal_errors=(BudgetExhaustedError,)
+        )
+        sections = {}
+        try:
+            while True:
+                with self.metrics.timed_sql('claim_crawl_items'):
+                    items = self.crawl_queue.claim(job_id, self.search_workers * 2)
+                if not items:
+                    break
+                for item in items:
+                    if item['section_id'] not in sections:
+                        sections[item['section_id']] = self.get_section((item['section_id'],))
+                    scheduler.add(PageCursor(sections[item['section_id']], item['query'], item['page_token'],
+                                             item['page'], item['results'], item['item_id']))
+                scheduler.run()
+        except BaseException:
+            # Cost limit reached or interrupted: the pages fetched are stored, the ones not requested yet go back to
+            # the queue for the next run
+            self.crawl_queue.release()
+            raise
+
+        if not self.crawl_queue.finish_job(job_id):
+            print(f"Crawl job {job_id} is still being crawled by other workers: {self.crawl_queue.progress(job_id)}")
+            return
 
-        """
-        Dynamically adjust the number of queries based on the population size.
-        If the population is below certain thresholds, fewer queries are used.
-        This is determined by comparing the population to a list of thresholds and counting
-        how many thresholds are exceeded, which corresponds to the number of queries to use.
-        """
-        population_threshold = [0, 50000, 150000, 300000]
-        queries = []
-        num_queries = sum(population >= threshold for threshold in population_threshold)
-        queries.extend(self.current_company_queries[:num_queries])
-
-        for query in queries:
-            if query == "":
-                self.error('There are no queries to get companies, please review your config.ini', True)
-
-            next_page = None
-            cont = 0
-            max_companies_per_section = 1000  # Update as desired
-            companies_per_page = 20  # Assuming Google Place API returns 20 results per request
-
-            while (cont == 0 or next_page) and cont <= math.ceil(max_companies_per_section / companies_per_page):
-                cont += 1
-
-                params = {
-                    'query': query,
-                    'location': f'{lat},{lon}',
-                    'radius': 50000,
-                    'language': 'es'
-                }
+        job_sections = [self.get_section((section_id,)) for section_id in self.crawl_queue.section_ids(job_id)]
+        saturated_section_ids = set(self.crawl_queue.saturated_section_ids(job_id, RESULTS_CAP))
+        # Only the sections whose results were not cut by the cap count as coverage for the planner
+        self.mark_sections_crawled([(section, None) for section in job_sections
+                                    if section['section_id'] in saturated_section_ids])
+        self.mark_sections_crawled([(section, None) for section in job_sections
+                                    if section['section_id'] not in saturated_section_ids], searched=True)
+        for section_id in saturated_section_ids:
+            self.subdivide_section(self.get_section((section_id,)))
+        print(f"Crawl job {job_id} finished: {self.crawl_queue.progress(job_id)}")
+
+    def get_section_queries(self, population):
+        if len(self.current_company_queries) == 0 or "" in self.current_company_queries:
+            self.error('There are no queries to get companies, please review your config.ini')
+            raise ConfigError('There are no queries to get companies')
+
+        return self.section_planner.queries_for(population)
+
+    def plan_section_queries(self, sections, budget=None):
+        """Picks the queries of each section from the yield of past searches (see QueryPlanner): as many queries as
+        the population of the section allows, the best ones, without the low yield ones. Returns the planned
+        (section_id, query, estimated yield), most new places per dollar first, and the skipped ones."""
+        queries = self.current_company_queries
+        max_queries = [(section['section_id'], len(self.get_section_queries(section['population'])))
+                       for section in sections]
+        planned, skipped = self.query_planner.plan(max_queries, queries, self.get_query_yields(sections), budget)
+        low_yield = sum(reason == 'low_yield' for _, _, _, reason in skipped)
+        if low_yield:
+            print(f"Skipped {low_yield} queries finding too few new places")
+        if len(skipped) > low_yield:
+            print(f"Skipped {len(skipped) - low_yield} queries over the crawl budget of ${budget:.2f}")
+        return planned, skipped
+
+    def get_query_yields(self, sections):
+        """Pages and new places of the searches of the last QueryYieldMaxAgeDays: of every search by query, and of
+        the last search of each (section, query) of sections"""
+        since = (datetime.date.today() - datetime.timedelta(days=self.query_yield_max_age_days)).strftime('%Y-%m-%d')
+        section_ids = [section['section_id'] for section in sections]
+        with self.db_lock, self.metrics.timed_sql('select_query_yields'):
+            query_rows = self.cursor.execute('''
+                SELECT query, SUM(page = 0), COUNT(*), SUM(new_places) FROM query_yield
+                WHERE crawled_at >= ? GROUP BY query
+            ''', (since,)).fetchall()
+            # The pages of a search are stored after its first page
+            section_rows = self.cursor.execute(f'''
+                SELECT y.section_id, y.query, COUNT(*), SUM(y.new_places) FROM query_yield y
+                JOIN (
+                    SELECT section_id, query, MAX(rowid) AS first_page FROM query_yield
+                    WHERE page = 0 AND crawled_at >= ? AND section_id IN ({', '.join('?' * len(section_ids))})
+                    GROUP BY section_id, query
+                ) last_search ON last_search.section_id = y.section_id AND last_search.query = y.query
+                AND y.rowid >= last_search.first_page
+                GROUP BY y.section_id, y.query
+            ''', [since] + section_ids).fetchall()
+        return QueryYields(query_rows, section_rows)
+
+    def fetch_search_page(self, cursor):
+        """Scheduler worker: requests the next page of a (section, query) cursor"""
+        section = cursor.section
+        params = {
+            'query': cursor.query,
+            'location': f"{section['lat']},{section['lon']}",
+            'radius': section['radius'],
+            'language': 'es'
+        }
 
-                if next_page:
-                    params['page_token'] = next_page
+        if cursor.page_token:
+            params['page_token'] = cursor.page_token
 
-                search_results = self.google_places_request('text_search', 'places', params)
+        try:
+            return self.google_places_request('text_search', 'places', params)
+        except CacheMissError as e:
+            self.error(f"Skipping {cursor.query} on {params['location']}: {e}")
+            return None
+
+    def store_search_page(self, cursor, search_results):
+        """Scheduler writer: parses and stores a page of search results, checkpointing its crawl item in the same
+        transaction"""
+        section = cursor.section
+        today_str = datetime.date.today().strftime('%Y-%m-%d')
+
+        results = [result for result in search_results.get('results', []) if 'place_id' in result and 'name' in result]
+        parsed_addresses = address_parser.parse_addresses([result['formatted_address'] for result in results])
+
+        company_rows = []
+        for result, (country, state, city, address, postal_code) in zip(results, parsed_addresses):
+            location = result.get('geometry', {}).get('location', {})
+            company_rows.append((result['place_id'], result['name'], section['section_id'], country, state,
+                                 city, address, postal_code, today_str, location.get('lat'), location.get('lng')))
+
+        if not company_rows:
+            self.error(f"Could not find result for latitude {section['lat']} and longitude {section['lon']}.")
+
+        with self.db_lock, self.metrics.timed_sql('store_search_page', len(company_rows)):
+            new_places = len(company_rows) - self.count_known_places([row[0] for row in company_rows])
+            if company_rows:
+                self.store_companies(company_rows, commit=False)
+            self.cursor.execute('''
+                INSERT INTO query_yield (section_id, query, page, results, new_places, crawled_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (section['section_id'], cursor.query, cursor.page - 1, len(company_rows), new_places, today_str))
+            if cursor.page_token and self.query_planner.stop_paging(len(company_rows), new_places):
+                # The next pages would mostly bring places we already have
+                cursor.page_token = None
+            cursor.item_id = self.crawl_queue.checkpoint(cursor.item_id, cursor.results, cursor.page_token)
+            self.conn.commit()
 
-                if 'next_page_token' in search_results:
-                    next_page = search_results.get('next_page_token')
-                    params['next_page_token'] = next_page
-                else:
-                    next_page = None
-
-                committed = False
-                if 'results' in search_results:
-                    for result in search_results['results']:
-                        if 'place_id' in result and 'name' in result:
-                            today_str = datetime.date.today().strftime('%Y-%m-%d')
-                            country, state, city, address, postal_code = self.parse_address(result['formatted_address'])
-
-                            self.cursor.execute('''INSERT INTO company (place_id, name, section_id, country, state, 
-                                                    city, address, postal_code, updated_at)
-                                                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(place_id) DO 
-                                                   UPDATE SET name = ?, section_id = ?, country = ?, state = ?, city = ?, 
-                                                   address = ?, postal_code = ?, updated_at = ?''',
-                                                (result['place_id'], result['name'],
-                                                 section_id, country, state, city, address, postal_code, today_str,
-                                                 result['name'], section_id, country, state, city, address, postal_code,
-                                                 today_str))
-                            self.conn.commit()
-                            committed = True
-                if not committed:
-                    self.error(f'Could not find result for latitude {lat} and longitude {lon}.')
+        if cursor.item_id is None:
+            # Last page, or another worker took over the query after our lease expired
+            cursor.page_token = None
+        self.metrics.count_rows(section['section_id'], cursor.query, len(company_rows), new_places)
+
+    def count_known_places(self, place_ids):
+        """Number of place_ids already in the database"""
+        if not place_ids:
+            return 0
+        return self.cursor.execute(f'''
+            SELECT COUNT(*) FROM company WHERE place_id IN ({', '.join('?' * len(place_ids))})
+        ''', place_ids).fetchone()[0]
+
+    def drop_search_page(self, cursor, reason):
+        """Scheduler callback for the pages given up, e.g. after too many errors"""
+        self.crawl_queue.fail(cursor.item_id, reason)
+
+    def store_companies(self, company_rows, commit=True):
+        """Upserts a page of parsed search results, rows of (place_id, name, section_id, country, state, city,
+        address, postal_code, today, lat, lon), in a single transaction.
+        A company keeps the section that found it first, every section seeing it is recorded in company_section.
+        Companies that didn't change are not written, so updated_at is the date of the last change. Companies
+        sharing a blocking key (normalized name, postal code and geohash) point to the first of them in
+        duplicate_of. The full address and Google search URL of the exports are stored with them."""
+        rows = []
+        for row in company_rows:
+            cell = company_dedup.geohash(row[9], row[10]) if row[9] is not None and row[10] is not None else None
+            rows.append(row + (cell, company_dedup.blocking_key(row[1], row[7], cell),
+                               address_parser.full_address(row[6], row[4], row[5], row[7]),
+                               address_parser.search_url(row[1], row[6])))
+        with self.db_lock:
+            self.cursor.executemany('''INSERT INTO company (place_id, name, section_id, country, state, 
+                                        city, address, postal_code, updated_at, lat, lon, geohash, blocking_key,
+                                        full_address, search_url)
+                                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(place_id) DO 
+                                       UPDATE SET name = excluded.name, country = excluded.country,
+                                       state = excluded.state, city = excluded.city, address = excluded.address,
+                                       postal_code = excluded.postal_code, lat = excluded.lat, lon = excluded.lon,
+                                       geohash = excluded.geohash, blocking_key = excluded.blocking_key,
+                                       full_address = excluded.full_address, search_url = excluded.search_url,
+                                       updated_at = excluded.updated_at
+                                       WHERE name IS NOT excluded.name OR country IS NOT excluded.country
+                                       OR state IS NOT excluded.state OR city IS NOT excluded.city
+                                       OR address IS NOT excluded.address OR postal_code IS NOT excluded.postal_code
+                                       OR blocking_key IS NOT excluded.blocking_key''', rows)
+            self.cursor.executemany('''
+                INSERT INTO company_section (place_id, section_id, first_seen_at, last_seen_at)
+                VALUES (?, ?, ?, ?) ON CONFLICT(place_id, section_id) DO
+                UPDATE SET last_seen_at = excluded.last_seen_at WHERE last_seen_at < excluded.last_seen_at
+            ''', [(row[0], row[2], row[8], row[8]) for row in rows])
+            self.cursor.executemany('''
+                UPDATE company SET duplicate_of = NULLIF(
+                    (SELECT MIN(c.place_id) FROM company c WHERE c.blocking_key = company.blocking_key), place_id
+                )
+                WHERE blocking_key = ? AND duplicate_of IS NOT NULLIF(
+                    (SELECT MIN(c.place_id) FROM company c WHERE c.blocking_key = company.blocking_key), place_id
+                )
+            ''', [(key,) for key in {row[12] for row in rows if row[12] is not None}])
+            if commit:
+                self.conn.commit()
 
     @staticmethod
     def has_postal_code(address_element):
-        # Regular expression to find if the address element has a spanish postal code (5 digits)
-        postal_code_match = re.search(r'\d{5}\b', address_element)
-        if postal_code_match:
-            return True
-        return False
+        return address_parser.has_postal_code(address_element)
 
     @staticmethod
     def remove_postal_code(text):
         """Remove postal code from passed text"""
-        return re.sub(r'\b\d{5}\b', '', text).strip()
-
-    def parse_address(self, address_string):
-
-        country = state = city = address = postal_code = ''
-        splitted_result = address_string.split(',')
-        splitted_result.reverse()
-        address_parts = []
-
-        for part in splitted_result:
-            part = part.strip()
-            if postal_code == '' and self.has_postal_code(part):
-                subpart = part.split(' ', 1)
-                if len(subpart) == 2:
-                    postal_code = subpart[0]
-                    city = subpart[1]
-                else:
-                    postal_code = subpart[0]
-
-            if country == '':
-                country = part
-            elif state == '':
-                state = part
-            elif city == '' or city in part:
-                city = part
-            else:
-                address_parts.append(part)
+        return address_parser.remove_postal_code(text)
 
-        country = self.remove_postal_code(country)
-        state = self.remove_postal_code(state)
-        city = self.remove_postal_code(city)
-        address_parts.reverse()
-        address_parts = [self.remove_postal_code(part) for part in address_parts]
-        address = ', '.join(address_parts)
-
-        if city == '':
-            city = state
-
-        return country, state, city, address, postal_code
+    @staticmethod
+    def parse_address(address_string):
+        return address_parser.parse_address(address_string)
 
     def get_most_outdated_sections(self, limit=20):
-        """ Gets sections ordering by date, then returns the section_ids """
+        """ Gets the sections crawled the longest time ago (never crawled first), then returns the section_ids. Split
+        sections are searched through their children. """
         self.cursor.execute('''
-            SELECT s.section_id FROM section s
-            LEFT JOIN company c ON c.section_id = s.section_id
-            ORDER BY c.updated_at ASC, RANDOM()
+            SELECT section_id FROM section s
+            WHERE NOT EXISTS (SELECT 1 FROM section child WHERE child.parent_section_id = s.section_id)
+            ORDER BY last_crawled_at ASC, section_id ASC
             LIMIT ?
         ''', (limit,))
 
         return self.cursor.fetchall()
 
     def get_section(self, selected_section):
-        self.cursor.execute("SELECT * FROM section WHERE section_id = ?"
-                            , selected_section)
+        self.cursor.execute('''
+            SELECT section_id, name, lat, lon, population, radius,
+            EXISTS(SELECT 1 FROM section child WHERE child.parent_section_id = section.section_id)
+            FROM section WHERE section_id = ?
+        ''', selected_section)
         section_row = self.cursor.fetchone()
+        if section_row is None:
+            raise ValueError(f'There is no section {selected_section[0]}')
+        return self._section_from_row(section_row)
+
+    def _section_from_row(self, section_row):
         section = {
             'section_id': section_row[0],
             'name': section_row[1],
             'lat': section_row[2],
             'lon': section_row[3],
-            'population': section_row[4]
+            'population': section_row[4],
+            'radius': section_row[5] or self.search_radius,
+            'subdivided': bool(section_row[6])
         }
         return section
 
-    def update_companies(self, sections_limit=10):
-
-        outdated_sections = self.get_most_outdated_sections(sections_limit)
-        for outdated_section in outdated_sections:
-            selected_section = self.get_section(outdated_section)
-
-            if selected_section:
-                print(f"Querying {selected_section.get('name')}: Coordinates: {selected_section.get('lat')} "
-                      f"| {selected_section.get('lon')}")
-                self.search_and_store_companies(
-                    selected_section['lat'], selected_section['lon'], selected_section['section_id'],
-                    selected_section['population']
-                )
-            else:
-                print("There are no sections in the database... Exiting")
-                exit(0)
-
-        self.close_connection()
+    def get_recently_crawled_sections(self):
+        """ Sections whose searches finished unsaturated in the last CoverageMaxAgeDays, except the split ones since
+        their results were cut """
+        self.cursor.execute('''
+            SELECT section_id, name, lat, lon, population, radius, 0 FROM section s
+            WHERE searched_at >= ?
+            AND NOT EXISTS (SELECT 1 FROM section child WHERE child.parent_section_id = s.section_id)
+        ''', ((datetime.datetime.now() - datetime.timedelta(days=self.coverage_max_age_days))
+              .strftime('%Y-%m-%d %H:%M:%S'),))
+        return [self._section_from_row(section_row) for section_row in self.cursor.fetchall()]
+
+    def mark_sections_crawled(self, sections, searched=False):
+        """ Sets the crawl date of (section, covered_by_section_id) pairs, covered sections count as crawled. The
+        searched ones, whose searches finished without hitting the results cap, also cover their neighbours. """
+        now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.db_lock:
+            self.cursor.executemany(
+                "UPDATE section SET last_crawled_at = ?, covered_by_section_id = ?, "
+                "searched_at = CASE WHEN ? THEN ? ELSE searched_at END WHERE section_id = ?",
+                [(now, covered_by, searched, now, section['section_id']) for section, covered_by in sections]
+            )
+            self.conn.commit()
 
-    def insert_section_data_samples(self):
-        """Inserts predefined geographic sections covering different parts of Spain."""
-        self.cursor.execute("SELECT COUNT(*) FROM section")
-        count = self.cursor.fetchone()[0]
+    def subdivide_section(self, section):
+        if section['subdivided']:
+            return
 
-        if count > 0:
+        children = self.section_planner.subdivide(section)
+        if not children:
             return
 
-        # Obtained from https://simplemaps.com/
-        with open('sections.json', 'r') as file:
-            section_data = json.load(file)
+        print(f"Splitting {section['name']} into {len(children)} smaller sections")
+        with self.db_lock:
+            self.cursor.executemany('''
+                INSERT INTO section (name, lat, lon, population, radius, parent_section_id)
+                VALUES (:name, :lat, :lon, :population, :radius, :parent_section_id)
+            ''', children)
+            self.conn.commit()
 
-        for section, data in section_data.items():
-            self.cursor.execute(
-                f"INSERT INTO section (name, lat, lon, population) "
-                f"VALUES ('{section}', {data['lat']}, {data['lon']}, {data['population']});"
-            )
+    @metered_run
+    def update_companies(self, sections_limit=10):
+        """Resumes the unfinished crawl job, or plans a new one with the most outdated sections"""
+        job_id = self.crawl_queue.running_job()
+        if job_id is not None:
+            print(f"Resuming crawl job {job_id}: {self.crawl_queue.progress(job_id)}")
+        else:
+            job_id = self.plan_crawl_job(sections_limit)
+
+        if job_id is not None:
+            self.run_crawl_job(job_id)
+
+    def plan_crawl_job(self, sections_limit):
+        """Creates a crawl job with the outdated sections not covered by recent searches and returns its id. The
+        queries of the sections are planned by their expected new places per dollar within the budget of the job,
+        CrawlJobMaxCost or the monthly budget left."""
+        budget = self.max_monthly_cost - self.cost_ledger.monthly_cost()
+        if budget <= 0:
+            self.error('Monthly API cost limit reached')
+            raise BudgetExhaustedError('Monthly API cost limit reached')
+        if self.crawl_job_max_cost > 0:
+            budget = min(budget, self.crawl_job_max_cost)
+
+        # Get more candidates than needed, some of them may be covered by the searches of their neighbours
+        outdated_sections = self.get_most_outdated_sections(sections_limit * 3)
+        if not outdated_sections:
+            self.error('There are no sections in the database')
+            raise ConfigError('There are no sections in the database')
+
+        candidates = {}
+        for outdated_section in outdated_sections:
+            selected_section = self.get_section(outdated_section)
+            candidates.setdefault(selected_section['section_id'], selected_section)
+
+        sections, skipped = self.section_planner.plan(
+            list(candidates.values()), self.get_recently_crawled_sections(), sections_limit
+        )
+        for section in sections:
+            print(f"Querying {section.get('name')}: Coordinates: {section.get('lat')} | {section.get('lon')}")
+
+        if skipped:
+            self.mark_sections_crawled([(section, covered_by) for section, covered_by, _ in skipped])
+            print(f"Skipped {len(skipped)} sections already covered by other searches, estimated saving: "
+                  f"${sum(saving for _, _, saving in skipped):.2f}")
+
+        planned, skipped_queries = self.plan_section_queries(sections, budget)
+        # Sections whose queries were all skipped as low yield count as crawled, the ones over the budget don't
+        planned_section_ids = {section_id for section_id, _, _ in planned}
+        over_budget_section_ids = {section_id for section_id, _, _, reason in skipped_queries if reason == 'budget'}
+        self.mark_sections_crawled([(section, None) for section in sections
+                                    if section['section_id'] not in planned_section_ids | over_budget_section_ids])
+
+        # Another worker may have created a job meanwhile, then we join it
+        job_id, _ = self.crawl_queue.create_job([(section_id, query) for section_id, query, _ in planned],
+                                                exclusive=True)
+        return job_id
+
+    def insert_section_data_samples(self, path='sections.json'):
+        """Inserts predefined geographic sections covering different parts of Spain, in a single transaction.
+        Does nothing, without reading the file, if there are sections already."""
+        with self.db_lock:
+            if self.cursor.execute("SELECT EXISTS(SELECT 1 FROM section)").fetchone()[0]:
+                return
+
+            # Obtained from https://simplemaps.com/
+            with open(path, 'r') as file:
+                section_data = json.load(file)
+
+            self.cursor.executemany("INSERT INTO section (name, lat, lon, population) VALUES (?, ?, ?, ?)",
+                                    [(section, data['lat'], data['lon'], data['population'])
+                                     for section, data in section_data.items()])
             self.conn.commit()
 
+    @classmethod
+    def schema_up_to_date(cls, conn):
+        """True when the database has the last migration"""
+        try:
+            version = conn.execute('SELECT MAX(version) FROM schema_migrations').fetchone()[0]
+        except sqlite3.OperationalError:
+            # New database
+            version = None
+        return version == cls.MIGRATIONS[-1][0]
+
+    def _ensure_schema(self):
+        """Creates and migrates the schema, unless the database already has the last migration"""
+        if not self.schema_up_to_date(self.conn):
+            self._create_tables()
+
     def _create_tables(self):
         """Creates necessary tables in the database if they do not already exist."""
         self.cursor.execute('''
@@ -419,7 +1062,11 @@ class GooglePlacesManager:
                 name TEXT,
                 lat FLOAT,
                 lon FLOAT,
-                population FLOAT
+                population FLOAT,
+                radius FLOAT,
+                parent_section_id INTEGER,
+                last_crawled_at DATETIME,
+                covered_by_section_id INTEGER
             )
         ''')
 
@@ -434,8 +1081,263 @@ class GooglePlacesManager:
                 PRIMARY KEY (year, month)
             )
         ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS api_costs_by_type (
+                year INTEGER,
+                month INTEGER,
+                request_type TEXT,
+                query_count INTEGER,
+                cost REAL,
+                PRIMARY KEY (year, month, request_type)
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS api_cost_reservations (
+                owner TEXT,
+                year INTEGER,
+                month INTEGER,
+                amount REAL,
+                updated_at REAL,
+                PRIMARY KEY (owner, year, month)
+            )
+        ''')
         self.conn.commit()
 
+        self._migrate()
+
+    def _migrate(self):
+        """Applies the pending MIGRATIONS. BEGIN IMMEDIATE keeps two processes from migrating at the same time."""
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                applied_at DATETIME
+            )
+        ''')
+        self.conn.commit()
+
+        self.cursor.execute('BEGIN IMMEDIATE')
+        applied = {row[0] for row in self.cursor.execute('SELECT version FROM schema_migrations')}
+        for version, migration in self.MIGRATIONS:
+            if version in applied:
+                continue
+            getattr(self, migration)()
+            self.cursor.execute("INSERT INTO schema_migrations (version, applied_at) VALUES (?, datetime('now'))",
+                                (version,))
+        self.conn.commit()
+
+    def _migration_section_crawl_columns(self):
+        self._add_missing_columns('section', {
+            'radius': 'FLOAT',
+            'parent_section_id': 'INTEGER',
+            'last_crawled_at': 'DATETIME',
+            'covered_by_section_id': 'INTEGER',
+        })
+
+    def _migration_lookup_indexes(self):
+        """Indexes for the outdated sections and stale details selection"""
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_company_section_updated_at '
+                            'ON company (section_id, updated_at)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_company_detail_updated_at ON company (detail_updated_at)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_company_details_updated_at '
+                            'ON company_details (updated_at)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_section_last_crawled_at ON section (last_crawled_at)')
+
+        # Sections crawled before last_crawled_at existed
+        self.cursor.execute('''
+            UPDATE section SET last_crawled_at = (
+                SELECT MAX(c.updated_at) FROM company c WHERE c.section_id = section.section_id
+            ) WHERE last_crawled_at IS NULL
+        ''')
+
+    def _migration_review_table(self):
+        """Moves the reviews JSON of company_details into a review table"""
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS review (
+                place_id TEXT,
+                author_name TEXT,
+                time INTEGER,
+                author_url TEXT,
+                language TEXT,
+                original_language TEXT,
+                profile_photo_url TEXT,
+                rating INTEGER,
+                relative_time_description TEXT,
+                text TEXT,
+                translated BOOLEAN,
+                first_seen_at DATE,
+                updated_at DATE,
+                PRIMARY KEY (place_id, author_name, time)
+            )
+        ''')
+
+        details_rows = self.conn.execute(
+            'SELECT place_id, reviews, updated_at FROM company_details WHERE reviews IS NOT NULL'
+        ).fetchall()
+        for place_id, reviews_json, updated_at in details_rows:
+            try:
+                reviews = json.loads(reviews_json)
+            except json.JSONDecodeError:
+                continue
+            self.store_reviews(place_id, reviews, updated_at)
+
+        self.cursor.execute('UPDATE company_details SET reviews = NULL')
+
+    def _migration_details_field_groups(self):
+        """Refresh dates of each group of details fields, the stored photo reference and the review velocity"""
+        self._add_missing_columns('company_details', {
+            'contact_updated_at': 'DATE',
+            'atmosphere_updated_at': 'DATE',
+            'hours_updated_at': 'DATE',
+            'photo_updated_at': 'DATE',
+            'photo_reference': 'TEXT',
+            'review_velocity': 'REAL',
+        })
+        self.cursor.execute('''
+            UPDATE company_details SET contact_updated_at = updated_at, atmosphere_updated_at = updated_at,
+            hours_updated_at = updated_at, photo_updated_at = updated_at
+        ''')
+
+    def _migration_crawl_queue(self):
+        """Work queue of the resumable crawl, see CrawlQueue"""
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS crawl_job (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                state TEXT,
+                created_at DATETIME,
+                finished_at DATETIME
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS crawl_item (
+                item_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id INTEGER,
+                section_id INTEGER,
+                query TEXT,
+                page INTEGER,
+                page_token TEXT,
+                results INTEGER DEFAULT 0,
+                state TEXT,
+                lease_owner TEXT,
+                lease_id TEXT,
+                lease_expires_at REAL,
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                updated_at DATETIME,
+                UNIQUE (job_id, section_id, query, page)
+            )
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_crawl_item_job_state ON crawl_item (job_id, state)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_crawl_item_lease_id ON crawl_item (lease_id)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_crawl_job_state ON crawl_job (state)')
+
+    def _migration_company_sections_and_dedup(self):
+        """Sections where each company was seen, and the coordinates and blocking key of duplicate detection.
+        Companies crawled before have no coordinates, they get a blocking key when they are crawled again."""
+        self._add_missing_columns('company', {
+            'lat': 'REAL',
+            'lon': 'REAL',
+            'geohash': 'TEXT',
+            'blocking_key': 'TEXT',
+            'duplicate_of': 'TEXT',
+        })
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_company_blocking_key ON company (blocking_key)')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS company_section (
+                place_id TEXT,
+                section_id INTEGER,
+                first_seen_at DATE,
+                last_seen_at DATE,
+                PRIMARY KEY (place_id, section_id)
+            )
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_company_section_section_id ON company_section (section_id)')
+        self.cursor.execute('''
+            INSERT OR IGNORE INTO company_section (place_id, section_id, first_seen_at, last_seen_at)
+            SELECT place_id, section_id, updated_at, updated_at FROM company WHERE section_id IS NOT NULL
+        ''')
+
+    def _migration_photo_store(self):
+        """Stored photo file of the companies, and the index of the photos waiting to be resolved"""
+        self._add_missing_columns('company_details', {'photo_file': 'TEXT'})
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_company_details_pending_photo ON company_details (photo_updated_at)
+            WHERE place_photo IS NULL AND photo_reference IS NOT NULL
+        ''')
+
+    def _migration_query_yield(self):
+        """Results and new places of every text search page, see QueryPlanner"""
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS query_yield (
+                section_id INTEGER,
+                query TEXT,
+                page INTEGER,
+                results INTEGER,
+                new_places INTEGER,
+                crawled_at DATE
+            )
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_query_yield_crawled_at ON query_yield (crawled_at)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_query_yield_section ON query_yield (section_id, query)')
+
+    def _migration_read_aggregates(self):
+        """Stored full address and search URL of the companies, computed on every export before, and the aggregate
+        tables of the read API, kept up to date by triggers from now on"""
+        self._add_missing_columns('company', {'full_address': 'TEXT', 'search_url': 'TEXT'})
+        self.cursor.execute('''
+            UPDATE company SET full_address = address || ', ' || state || ', ' || city || ', ' || postal_code,
+            search_url = 'https://www.google.com/search?q=' || REPLACE(REPLACE(name || ' ' || address, ' ', '+'), ',',
+            '%2C') || '+opiniones'
+        ''')
+        # read_api pulls in http.server, only import it when migrating
+        import read_api
+
+        read_api.create_aggregates(self.conn)
+
+    def _migration_refresh_due_dates(self):
+        """Date each company is due for a details refresh ('' when it has no details) and the refresh schedule the
+        dates were computed with. The first details refresh computes the dates."""
+        self._add_missing_columns('company', {'refresh_due_at': "DATE DEFAULT ''"})
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_company_refresh_due ON company (refresh_due_at) '
+                            'WHERE duplicate_of IS NULL')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS refresh_schedule (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                schedule TEXT
+            )
+        ''')
+
+    def _migration_section_searched_at(self):
+        """Date the searches of a section last finished without hitting the results cap, the sections the planner
+        counts as coverage. last_crawled_at is also set for skipped sections, so it is not backfilled from it."""
+        self._add_missing_columns('section', {'searched_at': 'DATETIME'})
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_section_searched_at ON section (searched_at)')
+
+    def _add_missing_columns(self, table, columns):
+        """Adds the columns created after the first release to existing databases"""
+        existing_columns = {row[1] for row in self.cursor.execute(f'PRAGMA table_info({table})')}
+        for column, column_type in columns.items():
+            if column not in existing_columns:
+                self.cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
     def close_connection(self):
-        """Closes the SQLite database connection."""
+        """Flushes the API costs and closes the SQLite database connection."""
+        try:
+            self.cost_ledger.close()
+        except sqlite3.ProgrammingError:
+            # Already closed
+            pass
+        if self._photo_resolver is not None:
+            self._photo_resolver.close()
         self.conn.close()
+
+        if self.logger is not None:
+            for handler in self.logger.handlers:
+                handler.flush()
+
+        if self.response_cache is not None:
+            stats = self.response_cache.stats()
+            if stats['hits'] or stats['misses']:
+                print(f"Response cache: {stats['hits']} hits, {stats['misses']} misses, "
+                      f"{stats['evictions']} evictions")
+            self.response_cache.close()
+            self.response_cache = None
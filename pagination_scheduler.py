@@ -0,0 +1,136 @@
+import heapq
+import itertools
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class PageCursor:
+    """ Position of a (section, query) text search: the page token to request next and when it becomes valid """
+
+    def __init__(self, section, query, page_token=None, page=0, results=0, item_id=None):
+        self.section = section
+        self.query = query
+        self.page_token = page_token
+        self.page = page
+        self.results = results
+        # Crawl queue item of the page to request next
+        self.item_id = item_id
+        self.token_retries = 0
+        self.failures = 0
+
+
+class PageTokenNotReady(Exception):
+    """Google answers INVALID_REQUEST when a next_page_token is used before it becomes valid"""
+
+
+def is_page_token_not_ready(exception, params):
+    return 'page_token' in params and getattr(exception, 'status', None) == 'INVALID_REQUEST'
+
+
+class PaginationScheduler:
+    """ Walks many text search cursors at once. A next_page_token is only valid a short time after it is issued,
+        so instead of sleeping on it the scheduler requests the pages of other cursors in the meantime. Early tokens
+        are retried with a short exponential backoff, and cursors failing with a retryable error go back to the
+        queue to be retried later instead of aborting the whole run.
+
+        fetch_page(cursor) runs on up to `workers` threads and returns the search results (or None to drop the
+        cursor); store_page(cursor, results) always runs on the calling thread, with cursor.page_token already set
+        to the next page to request (None on the last page), and can clear it to stop the cursor.
+        drop_page(cursor, reason), if given, is called on the calling thread for the cursors given up.
+        fatal_errors raised by fetch_page stop the whole run, e.g. when the monthly cost limit is reached: no more
+        pages are requested, the pages in flight are still stored since they are paid, and the error is raised.
+        The cursors never fetched are left behind for the caller to give back.
+    """
+
+    def __init__(self, fetch_page, store_page, workers=4, max_pages=50, token_delay=1.5, token_backoff=0.5,
+                 max_token_retries=5, failure_delay=30, max_failures=2, error=print, drop_page=None,
+                 fatal_errors=()):
+        self.fetch_page = fetch_page
+        self.store_page = store_page
+        self.drop_page = drop_page
+        self.fatal_errors = fatal_errors
+        self.error = error
+        self.workers = workers
+        self.max_pages = max_pages
+        self.token_delay = token_delay
+        self.token_backoff = token_backoff
+        self.max_token_retries = max_token_retries
+        self.failure_delay = failure_delay
+        self.max_failures = max_failures
+        self.pending = []
+        self.sequence = itertools.count()
+
+    def add(self, cursor, ready_at=None):
+        heapq.heappush(self.pending, (ready_at or time.monotonic(), next(self.sequence), cursor))
+
+    def run(self):
+        in_flight = {}
+        fatal_error = None
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            # After a fatal error only the pages in flight are waited for
+            while (self.pending and fatal_error is None) or in_flight:
+                now = time.monotonic()
+                while (fatal_error is None and self.pending and len(in_flight) < self.workers
+                       and self.pending[0][0] <= now):
+                    _, _, cursor = heapq.heappop(self.pending)
+                    in_flight[executor.submit(self.fetch_page, cursor)] = cursor
+
+                # Wake up when a request finishes or when the next page token becomes valid
+                timeout = max(0.0, self.pending[0][0] - now) if self.pending and fatal_error is None else None
+                if not in_flight:
+                    time.sleep(timeout)
+                    continue
+
+                done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        self._handle_page(in_flight.pop(future), future)
+                    except self.fatal_errors as e:
+                        fatal_error = fatal_error or e
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        if fatal_error is not None:
+            raise fatal_error
+
+    def _handle_page(self, cursor, future):
+        try:
+            search_results = future.result()
+        except PageTokenNotReady:
+            cursor.token_retries += 1
+            if cursor.token_retries > self.max_token_retries:
+                self._drop(cursor, f'The page token of {cursor.query} on section {cursor.section["section_id"]} '
+                                   f'never became valid, stopping at page {cursor.page}')
+                return
+            self.add(cursor, time.monotonic() + self.token_backoff * 2 ** (cursor.token_retries - 1))
+            return
+        except self.fatal_errors:
+            raise
+        except Exception as e:
+            cursor.failures += 1
+            if getattr(e, 'retryable', False) and cursor.failures <= self.max_failures:
+                self.add(cursor, time.monotonic() + self.failure_delay)
+            else:
+                self._drop(cursor, f'Stopping {cursor.query} on section {cursor.section["section_id"]} at page '
+                                   f'{cursor.page}: {e}')
+            return
+
+        if search_results is None:
+            if self.drop_page:
+                self.drop_page(cursor, 'No response')
+            return
+
+        cursor.page += 1
+        cursor.results += len(search_results.get('results', []))
+        cursor.token_retries = 0
+        cursor.page_token = search_results.get('next_page_token') if cursor.page < self.max_pages else None
+        self.store_page(cursor, search_results)
+
+        if cursor.page_token:
+            self.add(cursor, time.monotonic() + self.token_delay)
+
+    def _drop(self, cursor, reason):
+        self.error(reason)
+        if self.drop_page:
+            self.drop_page(cursor, reason)
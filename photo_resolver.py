@@ -0,0 +1,69 @@
+import requests
+from requests.adapters import HTTPAdapter
+from googlemaps import exceptions as gmaps_exceptions
+
+from photo_store import PhotoDownloadError
+
+PHOTO_URL = 'https://maps.googleapis.com/maps/api/place/photo'
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class PhotoResolver:
+    """ Resolves Place Photos references into the URL of the image. The photo endpoint answers with a redirect to
+        the image: the URL is taken from its Location header and the image itself is never downloaded.
+
+        The requests of all the workers share one session, so connections to Google are kept alive and reused
+        instead of opening a TLS connection per photo. Errors are raised as googlemaps exceptions, which the request
+        executor knows how to retry.
+    """
+
+    def __init__(self, api_key, timeout=30, pool_size=10):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['DEFAULT']['GoogleApiKey'], timeout=config['DEFAULT'].getfloat('RequestTimeout', fallback=30),
+                   pool_size=max(1, config['DEFAULT'].getint('DetailsWorkers', fallback=1)))
+
+    def photo_url(self, photo_reference, max_width=None, max_height=None):
+        """ URL of the image of photo_reference, same arguments as googlemaps.Client.places_photo """
+        params = {'photoreference': photo_reference, 'key': self.api_key}
+        if max_width:
+            params['maxwidth'] = max_width
+        if max_height:
+            params['maxheight'] = max_height
+
+        try:
+            # The redirect body is a few bytes, reading it lets the connection go back to the pool
+            response = self.session.get(PHOTO_URL, params=params, allow_redirects=False, timeout=self.timeout)
+        except requests.exceptions.Timeout:
+            raise gmaps_exceptions.Timeout()
+        except requests.exceptions.RequestException as e:
+            raise gmaps_exceptions.TransportError(e)
+
+        if response.status_code in REDIRECT_STATUSES and response.headers.get('Location'):
+            return response.headers['Location']
+        if response.status_code == 200:
+            raise gmaps_exceptions.ApiError('INVALID_REQUEST', 'The photo endpoint answered without a redirect')
+        raise gmaps_exceptions.HTTPError(response.status_code)
+
+    def download(self, url, max_bytes):
+        """ Image at url, None when it is bigger than max_bytes """
+        try:
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                content = bytearray()
+                for chunk in response.iter_content(64 * 1024):
+                    content += chunk
+                    if len(content) > max_bytes:
+                        return None
+                return bytes(content)
+        except requests.exceptions.RequestException as e:
+            raise PhotoDownloadError(f'Could not download {url}: {e!r}') from e
+
+    def close(self):
+        self.session.close()
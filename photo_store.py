@@ -0,0 +1,73 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+# Extension of the stored files by the first bytes of the image
+IMAGE_SIGNATURES = ((b'\xff\xd8\xff', '.jpg'), (b'\x89PNG', '.png'), (b'RIFF', '.webp'), (b'GIF8', '.gif'))
+
+
+class PhotoDownloadError(Exception):
+    """A photo could not be downloaded from its URL"""
+
+
+class PhotoStore:
+    """ Local copies of the company photos, so exports don't depend on photo URLs that expire. Files are content
+        addressed (<sha256[:2]>/<sha256><extension>), a photo shared by several listings or downloaded again is
+        stored once. Photos bigger than max_file_bytes are not stored, nor any photo once the store holds max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes, max_file_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.lock = threading.Lock()
+        # Digests being written by other threads, already counted in size
+        self.writing = set()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for folder in os.scandir(directory) if folder.is_dir()
+                        for entry in os.scandir(folder.path) if entry.is_file())
+
+    @classmethod
+    def from_config(cls, config):
+        """ Store of PhotoStorePath in config.ini, None when it is not set """
+        directory = config['DEFAULT'].get('PhotoStorePath', fallback='')
+        if not directory:
+            return None
+        return cls(directory, config['DEFAULT'].getfloat('PhotoStoreMaxMb', fallback=500) * 1024 * 1024,
+                   config['DEFAULT'].getint('PhotoMaxKb', fallback=2048) * 1024)
+
+    def put(self, content):
+        """ Stores the photo and returns its path relative to the store, None when it doesn't fit """
+        if content is None or len(content) > self.max_file_bytes:
+            return None
+        digest = hashlib.sha256(content).hexdigest()
+        extension = next((extension for signature, extension in IMAGE_SIGNATURES if content.startswith(signature)),
+                         '.bin')
+        relative_path = os.path.join(digest[:2], digest + extension)
+        path = os.path.join(self.directory, relative_path)
+
+        # The existence check and the size reservation of a digest are one step, a photo stored by two workers at
+        # once is written and counted once
+        with self.lock:
+            if digest in self.writing or os.path.exists(path):
+                return relative_path
+            if self.size + len(content) > self.max_bytes:
+                return None
+            self.size += len(content)
+            self.writing.add(digest)
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written aside and renamed, a crash never leaves a truncated photo under its final name
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as file:
+                file.write(content)
+            os.replace(file.name, path)
+        except BaseException:
+            with self.lock:
+                self.size -= len(content)
+            raise
+        finally:
+            with self.lock:
+                self.writing.discard(digest)
+        return relative_path
@@ -0,0 +1,67 @@
+"""
+Places backends of the manager. A backend is an object with the methods of googlemaps.Client used by the manager:
+
+    place(place_id, fields=None, language=None) -> {'status': 'OK', 'result': {...}}
+    places(query=None, location=None, radius=None, language=None, page_token=None) -> {'results': [...], ...}
+
+and raises googlemaps.exceptions errors (request_executor.PlacesApiError for backends that don't depend on
+googlemaps), which the request executor knows how to retry. Photos are resolved by the photo resolver of the backend,
+with the methods:
+
+    photo_url(photo_reference, max_width=None, max_height=None) -> URL of the image
+    download(url, max_bytes) -> bytes of the image, None when bigger than max_bytes
+    close()
+"""
+
+BACKENDS = ('google', 'fake')
+
+
+def check_config(config):
+    """ Fails early on a config.ini the backend can't be built from, without building it """
+    backend = config['DEFAULT'].get('PlacesBackend', fallback='google').lower()
+    if backend not in BACKENDS:
+        raise ValueError(f'Invalid PlacesBackend {backend}, use one of {", ".join(BACKENDS)}')
+    if backend == 'google' and not config['DEFAULT'].get('GoogleApiKey'):
+        raise KeyError('GoogleApiKey')
+
+
+def create_client(config):
+    """ Builds the backend chosen by PlacesBackend in config.ini, google by default """
+    backend = config['DEFAULT'].get('PlacesBackend', fallback='google').lower()
+    if backend == 'google':
+        import googlemaps
+
+        # Retries are driven by our RequestExecutor, the client's own retries of OVER_QUERY_LIMIT and 5xx are off
+        client = googlemaps.Client(key=config['DEFAULT']['GoogleApiKey'], retry_over_query_limit=False,
+                                   timeout=config['DEFAULT'].getfloat('RequestTimeout', fallback=30))
+        client.session.hooks['response'].append(raise_server_errors)
+        return client
+    if backend == 'fake':
+        from fake_places import FakePlacesClient
+
+        return FakePlacesClient.from_config(config)
+
+    raise ValueError(f'Invalid PlacesBackend {backend}, use one of {", ".join(BACKENDS)}')
+
+
+def raise_server_errors(response, *args, **kwargs):
+    """ Response hook failing 5xx answers right away. googlemaps retries 500, 503 and 504 by itself until its
+        retry_timeout (60s) runs out and raises Timeout, this way they reach the RequestExecutor as a
+        TransportError on the first answer. """
+    if response.status_code >= 500:
+        # Not raise_for_status, its message holds the URL and the API key
+        from googlemaps.exceptions import HTTPError
+
+        raise HTTPError(response.status_code)
+
+
+def create_photo_resolver(config, client):
+    """ Photo resolver of the backend built by create_client: a PhotoResolver with pooled HTTP connections for
+        Google, the fake backend resolves its own photos """
+    backend = config['DEFAULT'].get('PlacesBackend', fallback='google').lower()
+    if backend == 'fake':
+        return client
+
+    from photo_resolver import PhotoResolver
+
+    return PhotoResolver.from_config(config)
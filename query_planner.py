@@ -0,0 +1,72 @@
+from section_planner import EXPECTED_PAGES_PER_QUERY
+
+RESULTS_PER_PAGE = 20
+
+
+class QueryYields:
+    """ Yield of the past text searches: pages requested and new places found (not in the database yet). Rows are
+        (query, searches, pages, new_places) of every search of each query, and (section_id, query, pages,
+        new_places) of the last search of each (section, query). """
+
+    def __init__(self, query_rows=(), section_rows=()):
+        self.by_query = {query: (searches, pages, new_places) for query, searches, pages, new_places in query_rows}
+        self.by_section = {(section_id, query): (pages, new_places)
+                           for section_id, query, pages, new_places in section_rows}
+
+
+class QueryPlanner:
+    """ Decides which queries are worth running on each section from the yield of past searches, in new places per
+        request. The next search of a (section, query) is expected to find as many new places as its last one. Pairs
+        never searched get the yield of the query on every section, smoothed towards an optimistic full page of new
+        places so new queries are tried first.
+
+        Queries whose expected yield is below min_query_yield are skipped, until their last search is too old to be
+        counted. The remaining (section, query) pairs are ordered by new places per dollar and planned until their
+        expected cost reaches the budget. While crawling, a query stops paging once a page has less than
+        min_page_yield new places per result.
+    """
+
+    def __init__(self, search_cost, min_page_yield=0.1, min_query_yield=0.5, prior_weight=2):
+        self.search_cost = search_cost
+        self.min_page_yield = min_page_yield
+        self.min_query_yield = min_query_yield
+        self.prior_weight = prior_weight
+
+    def estimate(self, yields, section_id, query):
+        """ Returns (new places per request, expected pages) of the next search of the query on the section """
+        if (section_id, query) in yields.by_section:
+            pages, new_places = yields.by_section[(section_id, query)]
+            return new_places / pages, pages
+
+        searches, pages, new_places = yields.by_query.get(query, (0, 0, 0))
+        query_yield = (new_places + self.prior_weight * RESULTS_PER_PAGE) / (pages + self.prior_weight)
+        return query_yield, pages / searches if searches else EXPECTED_PAGES_PER_QUERY
+
+    def plan(self, sections, queries, yields, budget=None):
+        """ Picks the queries of each (section_id, max_queries) of sections, up to max_queries of the best ones.
+            Returns the planned (section_id, query, expected yield), best first, and the skipped (section_id,
+            query, expected yield, reason), reason being 'low_yield' or 'budget' """
+        candidates, skipped = [], []
+        for section_id, max_queries in sections:
+            estimates = sorted(((self.estimate(yields, section_id, query), query) for query in queries),
+                               key=lambda estimate: -estimate[0][0])
+            for (query_yield, expected_pages), query in estimates[:max_queries]:
+                if query_yield < self.min_query_yield:
+                    skipped.append((section_id, query, query_yield, 'low_yield'))
+                else:
+                    candidates.append((section_id, query, query_yield, expected_pages * self.search_cost))
+
+        # Every page costs the same, so the most new places per dollar are the highest yields
+        candidates.sort(key=lambda candidate: -candidate[2])
+        planned, planned_cost = [], 0.0
+        for section_id, query, query_yield, expected_cost in candidates:
+            if budget is not None and planned_cost + expected_cost > budget:
+                skipped.append((section_id, query, query_yield, 'budget'))
+                continue
+            planned.append((section_id, query, query_yield))
+            planned_cost += expected_cost
+        return planned, skipped
+
+    def stop_paging(self, results, new_places):
+        """ True when a page brought too few new places to request the next one """
+        return results > 0 and new_places / results < self.min_page_yield
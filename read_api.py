@@ -0,0 +1,245 @@
+""" Read layer of the companies database: aggregate tables kept up to date by SQLite triggers on every write of the
+    crawl and the details refresh, a paginated query API over them, and a small read only HTTP endpoint:
+
+    GET /provinces?page=1&page_size=50             companies, details coverage, average rating and reviews
+    GET /cities?province=Madrid&page=1             the same by city
+    GET /reviews/months?page=1                     reviews and average rating by month the reviews were written
+    GET /companies?province=&city=&after=&limit=   companies with their details, after is the next cursor
+
+Duplicate listings are not counted nor listed.
+"""
+import json
+import sqlite3
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS company_stats (
+        state TEXT NOT NULL,
+        city TEXT NOT NULL,
+        companies INTEGER DEFAULT 0,
+        with_details INTEGER DEFAULT 0,
+        rated INTEGER DEFAULT 0,
+        rating_sum REAL DEFAULT 0,
+        reviews INTEGER DEFAULT 0,
+        PRIMARY KEY (state, city)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS review_stats (
+        month TEXT PRIMARY KEY,
+        reviews INTEGER DEFAULT 0,
+        rating_sum REAL DEFAULT 0
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_company_state_city ON company (state, city, place_id)',
+)
+
+STATS_UPSERT = '''
+    ON CONFLICT (state, city) DO UPDATE SET companies = companies + excluded.companies,
+    with_details = with_details + excluded.with_details, rated = rated + excluded.rated,
+    rating_sum = rating_sum + excluded.rating_sum, reviews = reviews + excluded.reviews;
+'''
+
+
+def _company_change(row, sign):
+    """ Adds (sign +) or removes (sign -) a company row and its details from company_stats """
+    return f'''
+        INSERT INTO company_stats (state, city, companies, with_details, rated, rating_sum, reviews)
+        SELECT IFNULL({row}.state, ''), IFNULL({row}.city, ''), {sign}1, {sign}(cd.place_id IS NOT NULL),
+        {sign}(cd.avg_reviews IS NOT NULL), {sign}IFNULL(cd.avg_reviews, 0), {sign}IFNULL(cd.total_reviews, 0)
+        FROM (SELECT 1) LEFT JOIN company_details cd ON cd.place_id = {row}.place_id
+        WHERE {row}.duplicate_of IS NULL
+    ''' + STATS_UPSERT
+
+
+def _details_change(row, sign):
+    """ Adds or removes a company_details row from the company_stats of its company """
+    return f'''
+        INSERT INTO company_stats (state, city, companies, with_details, rated, rating_sum, reviews)
+        SELECT IFNULL(c.state, ''), IFNULL(c.city, ''), 0, {sign}1, {sign}({row}.avg_reviews IS NOT NULL),
+        {sign}IFNULL({row}.avg_reviews, 0), {sign}IFNULL({row}.total_reviews, 0)
+        FROM company c WHERE c.place_id = {row}.place_id AND c.duplicate_of IS NULL
+    ''' + STATS_UPSERT
+
+
+def _review_change(row, sign):
+    return f'''
+        INSERT INTO review_stats (month, reviews, rating_sum)
+        VALUES (IFNULL(strftime('%Y-%m', {row}.time, 'unixepoch'), ''), {sign}1, {sign}IFNULL({row}.rating, 0))
+        ON CONFLICT (month) DO UPDATE SET reviews = reviews + excluded.reviews,
+        rating_sum = rating_sum + excluded.rating_sum;
+    '''
+
+
+TRIGGERS = {
+    'company_stats_insert': ('AFTER INSERT ON company', _company_change('NEW', '')),
+    'company_stats_update': (
+        'AFTER UPDATE OF state, city, duplicate_of ON company WHEN OLD.state IS NOT NEW.state '
+        'OR OLD.city IS NOT NEW.city OR OLD.duplicate_of IS NOT NEW.duplicate_of',
+        _company_change('OLD', '-') + _company_change('NEW', '')
+    ),
+    'company_stats_delete': ('AFTER DELETE ON company', _company_change('OLD', '-')),
+    'details_stats_insert': ('AFTER INSERT ON company_details', _details_change('NEW', '')),
+    'details_stats_update': (
+        'AFTER UPDATE OF avg_reviews, total_reviews ON company_details WHEN OLD.avg_reviews IS NOT NEW.avg_reviews '
+        'OR OLD.total_reviews IS NOT NEW.total_reviews',
+        _details_change('OLD', '-') + _details_change('NEW', '')
+    ),
+    'details_stats_delete': ('AFTER DELETE ON company_details', _details_change('OLD', '-')),
+    'review_stats_insert': ('AFTER INSERT ON review', _review_change('NEW', '')),
+    'review_stats_update': (
+        'AFTER UPDATE OF rating ON review WHEN OLD.rating IS NOT NEW.rating',
+        _review_change('OLD', '-') + _review_change('NEW', '')
+    ),
+    'review_stats_delete': ('AFTER DELETE ON review', _review_change('OLD', '-')),
+}
+
+
+def create_aggregates(conn):
+    """ Creates the aggregate tables and their triggers, and fills them from the current data """
+    for statement in SCHEMA:
+        conn.execute(statement)
+    for name, (event, body) in TRIGGERS.items():
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN {body} END')
+    rebuild_aggregates(conn)
+
+
+def rebuild_aggregates(conn):
+    """ Recomputes the aggregate tables from scratch, in the caller's transaction """
+    conn.execute('DELETE FROM company_stats')
+    conn.execute('''
+        INSERT INTO company_stats (state, city, companies, with_details, rated, rating_sum, reviews)
+        SELECT IFNULL(c.state, ''), IFNULL(c.city, ''), COUNT(*), COUNT(cd.place_id), COUNT(cd.avg_reviews),
+        IFNULL(SUM(cd.avg_reviews), 0), IFNULL(SUM(cd.total_reviews), 0)
+        FROM company c LEFT JOIN company_details cd ON cd.place_id = c.place_id
+        WHERE c.duplicate_of IS NULL
+        GROUP BY 1, 2
+    ''')
+    conn.execute('DELETE FROM review_stats')
+    conn.execute('''
+        INSERT INTO review_stats (month, reviews, rating_sum)
+        SELECT IFNULL(strftime('%Y-%m', time, 'unixepoch'), ''), COUNT(*), IFNULL(SUM(rating), 0)
+        FROM review GROUP BY 1
+    ''')
+
+
+class ReadApi:
+    """ Paginated queries over the aggregate tables and the companies. Aggregates return {'items', 'page',
+        'page_size', 'total'}, companies are paginated by place_id and return {'items', 'next'}. """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def provinces(self, page=1, page_size=DEFAULT_PAGE_SIZE):
+        return self._aggregate_page('''
+            SELECT state AS province, SUM(companies) AS companies, SUM(with_details) AS with_details,
+            SUM(rated) AS rated, SUM(rating_sum) AS rating_sum, SUM(reviews) AS reviews
+            FROM company_stats GROUP BY state HAVING SUM(companies) > 0
+        ''', (), 'companies DESC, province', page, page_size)
+
+    def cities(self, province=None, page=1, page_size=DEFAULT_PAGE_SIZE):
+        return self._aggregate_page('''
+            SELECT state AS province, city, companies, with_details, rated, rating_sum, reviews
+            FROM company_stats WHERE companies > 0 AND (? IS NULL OR state = ?)
+        ''', (province, province), 'companies DESC, province, city', page, page_size)
+
+    def review_months(self, page=1, page_size=DEFAULT_PAGE_SIZE):
+        result = self._aggregate_page('SELECT month, reviews, rating_sum FROM review_stats WHERE reviews > 0', (),
+                                      'month DESC', page, page_size)
+        for item in result['items']:
+            item['avg_rating'] = round(item.pop('rating_sum') / item['reviews'], 2)
+        return result
+
+    def companies(self, province=None, city=None, after=None, limit=DEFAULT_PAGE_SIZE):
+        limit = self._page_size(limit)
+        cursor = self.conn.execute('''
+            SELECT c.place_id, c.name, c.state AS province, c.city, c.postal_code, c.full_address, c.search_url,
+            cd.website, cd.phone_number, cd.avg_reviews AS rating, cd.total_reviews AS reviews,
+            cd.place_photo AS photo
+            FROM company c LEFT JOIN company_details cd ON cd.place_id = c.place_id
+            WHERE c.duplicate_of IS NULL AND (:province IS NULL OR c.state = :province)
+            AND (:city IS NULL OR c.city = :city) AND c.place_id > IFNULL(:after, '')
+            ORDER BY c.place_id LIMIT :limit
+        ''', {'province': province, 'city': city, 'after': after, 'limit': limit})
+        items = self._dicts(cursor)
+        return {'items': items, 'next': items[-1]['place_id'] if len(items) == limit else None}
+
+    def _aggregate_page(self, query, params, order_by, page, page_size):
+        page, page_size = max(1, int(page)), self._page_size(page_size)
+        total = self.conn.execute(f'SELECT COUNT(*) FROM ({query})', params).fetchone()[0]
+        cursor = self.conn.execute(f'{query} ORDER BY {order_by} LIMIT ? OFFSET ?',
+                                   params + (page_size, (page - 1) * page_size))
+        items = self._dicts(cursor)
+        for item in items:
+            if 'rated' in item:
+                rated, rating_sum = item.pop('rated'), item.pop('rating_sum')
+                item['avg_rating'] = round(rating_sum / rated, 2) if rated else None
+                item['details_coverage'] = round(item['with_details'] / item['companies'], 4)
+        return {'items': items, 'page': page, 'page_size': page_size, 'total': total}
+
+    @staticmethod
+    def _page_size(page_size):
+        return min(MAX_PAGE_SIZE, max(1, int(page_size)))
+
+    @staticmethod
+    def _dicts(cursor):
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+class ReadApiHandler(BaseHTTPRequestHandler):
+    """ JSON endpoint of the ReadApi, each request reads the database through its own read only connection """
+
+    routes = {
+        '/provinces': ('provinces', ('page', 'page_size')),
+        '/cities': ('cities', ('province', 'page', 'page_size')),
+        '/reviews/months': ('review_months', ('page', 'page_size')),
+        '/companies': ('companies', ('province', 'city', 'after', 'limit')),
+    }
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path not in self.routes:
+            return self._send(404, {'error': f'Unknown path {url.path}, use one of {", ".join(self.routes)}'})
+
+        method, names = self.routes[url.path]
+        query = parse_qs(url.query)
+        params = {name: query[name][0] for name in names if name in query}
+        conn = None
+        try:
+            conn = sqlite3.connect(f'file:{self.server.database_path}?mode=ro', uri=True)
+            self._send(200, getattr(ReadApi(conn), method)(**params))
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+        except sqlite3.Error as e:
+            # Missing aggregates (database not migrated yet), locked database...
+            self._send(503, {'error': f'Database unavailable: {e}'})
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _send(self, status, body):
+        content = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def serve(database_path, host='127.0.0.1', port=8000):
+    """ Serves the ReadApi over HTTP until interrupted """
+    server = ThreadingHTTPServer((host, port), ReadApiHandler)
+    server.database_path = database_path
+    print(f'Serving {database_path} on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,127 @@
+import datetime
+
+# Place details fields of each group, refreshed on their own schedule
+FIELD_GROUPS = {
+    'contact': ['website', 'formatted_phone_number'],
+    'atmosphere': ['rating', 'user_ratings_total', 'reviews'],
+    'hours': ['opening_hours'],
+    'photo': ['photo'],
+}
+# company_details columns written when each group is refreshed, besides <group>_updated_at
+GROUP_COLUMNS = {
+    'contact': ['website', 'phone_number'],
+    'atmosphere': ['total_reviews', 'avg_reviews', 'review_velocity'],
+    'hours': ['opening_hours'],
+    'photo': ['place_photo', 'photo_reference', 'photo_file'],
+}
+# Google bills the details request by the most expensive data SKU of each kind among the requested fields
+GROUP_SKUS = {'contact': 'contact', 'hours': 'contact', 'atmosphere': 'atmosphere', 'photo': 'basic'}
+
+
+class RefreshPlanner:
+    """ Decides which field groups of a company are stale, the field mask to request for them and what it costs.
+        Companies are ranked by their expected value of change: companies without details first, then by the
+        number of reviews they probably got since their last refresh (review velocity * days). """
+
+    def __init__(self, max_age_days, base_cost, sku_costs, photo_cost):
+        self.max_age_days = max_age_days
+        self.base_cost = base_cost
+        self.sku_costs = sku_costs
+        self.photo_cost = photo_cost
+
+    def schedule(self, default_days):
+        """ Days after which each group is stale, groups without max age use default_days """
+        return {group: default_days if self.max_age_days.get(group) is None else self.max_age_days[group]
+                for group in FIELD_GROUPS}
+
+    def cutoffs(self, today, default_days):
+        """ Refresh dates before which each group is stale """
+        return {group: (today - datetime.timedelta(days=days)).strftime('%Y-%m-%d')
+                for group, days in self.schedule(default_days).items()}
+
+    @staticmethod
+    def due_date_sql(schedule):
+        """ SQL expression of the date the first group of a company_details row `cd` gets stale, '' when a group
+            was never refreshed. A company is stale when its due date is before today. """
+        return 'MIN({})'.format(', '.join(f"IFNULL(date(cd.{group}_updated_at, '+{days} days'), '')"
+                                          for group, days in schedule.items()))
+
+    @staticmethod
+    def rank(candidates, today, limit):
+        """ The limit candidates with the highest expected value of change: without details first, then by
+            review velocity * days since the last reviews refresh, then the least recently refreshed """
+        def value_of_change(candidate):
+            days = 0
+            if candidate['atmosphere_updated_at'] is not None:
+                days = (today - datetime.date.fromisoformat(candidate['atmosphere_updated_at'][:10])).days
+            return (candidate['has_details'], -(candidate['review_velocity'] or 0) * days,
+                    candidate['detail_updated_at'] or '')
+
+        return sorted(candidates, key=value_of_change)[:limit]
+
+    def stale_groups(self, candidate, cutoffs):
+        return [group for group in FIELD_GROUPS
+                if candidate.get(f'{group}_updated_at') is None or candidate[f'{group}_updated_at'] < cutoffs[group]]
+
+    @staticmethod
+    def field_mask(groups):
+        return [field for group in groups for field in FIELD_GROUPS[group]]
+
+    def details_cost(self, groups):
+        skus = {GROUP_SKUS[group] for group in groups}
+        return round(self.base_cost + sum(self.sku_costs.get(sku, 0) for sku in skus), 6)
+
+    @staticmethod
+    def review_velocity(candidate, total_reviews, today):
+        """ Reviews per day, smoothed with the previous velocity """
+        if candidate.get('atmosphere_updated_at') is None or candidate.get('total_reviews') is None \
+                or total_reviews is None:
+            return candidate.get('review_velocity')
+
+        days = (today - datetime.date.fromisoformat(candidate['atmosphere_updated_at'][:10])).days
+        if days <= 0:
+            return candidate.get('review_velocity')
+
+        observed = max(0, total_reviews - candidate['total_reviews']) / days
+        if candidate.get('review_velocity') is None:
+            return round(observed, 6)
+        return round((candidate['review_velocity'] + observed) / 2, 6)
+
+
+class RefreshStats:
+    """ Cost of a details refresh run, details served from the response cache cost nothing """
+
+    def __init__(self):
+        self.companies = 0
+        self.cached = 0
+        self.cost = 0.0
+        self.groups = {group: 0 for group in FIELD_GROUPS}
+        self.photo_requests = 0
+        self.photo_requests_skipped = 0
+        self.photos_stored = 0
+
+    def add(self, details):
+        self.companies += 1
+        if details['billed']:
+            self.cost = round(self.cost + details['cost'], 6)
+        else:
+            self.cached += 1
+        for group in details['groups']:
+            self.groups[group] += 1
+        if details.get('photo_unchanged'):
+            self.photo_requests_skipped += 1
+
+    def add_photo(self, cost, photo_file=None):
+        self.photo_requests += 1
+        self.cost = round(self.cost + cost, 6)
+        if photo_file:
+            self.photos_stored += 1
+
+    def report(self):
+        if not self.companies:
+            return 'No company details refreshed'
+        groups = ', '.join(f'{group}: {count}' for group, count in self.groups.items())
+        return (f'Refreshed {self.companies} companies ({groups}) for ${self.cost:.3f}, '
+                f'${self.cost / self.companies:.4f} per company, {self.cached} from the response cache. '
+                f'Photo requests: {self.photo_requests}, skipped as unchanged: {self.photo_requests_skipped}, '
+                f'stored: {self.photos_stored}')
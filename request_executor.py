@@ -0,0 +1,225 @@
+import random
+import threading
+import time
+
+# Google statuses worth retrying, the rest (INVALID_REQUEST, NOT_FOUND, REQUEST_DENIED...) fail the same way again
+RETRYABLE_STATUSES = ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+# Error statuses Google answers without billing the request
+UNBILLED_STATUSES = ('INVALID_REQUEST', 'OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+
+
+class BudgetExhaustedError(Exception):
+    """Raised when a request would exceed the monthly API cost limit"""
+
+
+class PlacesApiError(Exception):
+    """Error status answered by a Places backend other than Google, handled like googlemaps.exceptions.ApiError"""
+
+    def __init__(self, status, message=None):
+        super().__init__(status, message)
+        self.status = status
+        self.message = message
+
+
+class PlacesRequestError(Exception):
+    """A request that failed after the retry policy gave up. Retryable failures may succeed in a later pass."""
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class TokenBucket:
+    """ Thread safe token bucket allowing `rate` requests per second with bursts of up to `burst` requests """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """ Opens after `failure_threshold` consecutive retryable failures and rejects requests for `reset_timeout`
+        seconds, then lets a single trial request through (half open) before closing again """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def release_trial(self):
+        """ The trial request was never sent, another request may be the trial """
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    def cooldown_remaining(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+
+class RequestExecutor:
+    """ Sends the Google requests: rate limits them per request type, retries transient errors with exponential
+        backoff and jitter, and stops sending while the circuit breaker is open.
+
+        The cost is charged before each attempt so the monthly limit holds, and refunded when Google answered with
+        an error status it doesn't bill or the request was never sent. Timeouts and other failures after sending
+        stay charged, Google may have processed them.
+
+        observe(request_type, seconds, attempts, failed), if given, is called after every request.
+    """
+
+    def __init__(self, charge, refund, rates=None, max_retries=3, base_delay=1.0, max_delay=30.0,
+                 breaker=None, passthrough_errors=(), observe=None):
+        self.charge = charge
+        self.refund = refund
+        self.limiters = {request_type: TokenBucket(rate) for request_type, rate in (rates or {}).items() if rate > 0}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        # Errors handled by the caller, raised as they are and never retried
+        self.passthrough_errors = passthrough_errors
+        self.observe = observe
+
+    def execute(self, request_type, send, cost=None):
+        """ Sends the request, cost overrides the default cost of the request type """
+        start = time.perf_counter()
+        attempts = 0
+        failed = True
+        try:
+            for attempt in range(self.max_retries + 1):
+                if not self.breaker.allow():
+                    raise PlacesRequestError(f'{request_type} request rejected, too many errors from Google', True)
+
+                try:
+                    if request_type in self.limiters:
+                        self.limiters[request_type].acquire()
+
+                    if not self.charge(request_type, cost):
+                        raise BudgetExhaustedError('Monthly API cost limit reached')
+                except BaseException:
+                    # Not sent: a half open breaker would otherwise wait forever for this trial
+                    self.breaker.release_trial()
+                    raise
+
+                attempts += 1
+                try:
+                    response = send()
+                except self.passthrough_errors:
+                    self.refund(request_type, cost)
+                    self.breaker.record_success()
+                    # Handled by the caller, not a failure of the request
+                    failed = False
+                    raise
+                except Exception as e:
+                    if not self.is_billed(e):
+                        self.refund(request_type, cost)
+
+                    if not self.is_retryable(e):
+                        # Google answered, the service is fine
+                        self.breaker.record_success()
+                        raise PlacesRequestError(f'The {request_type} query returned an error {e!r}') from e
+
+                    self.breaker.record_failure()
+                    if attempt == self.max_retries:
+                        raise PlacesRequestError(f'The {request_type} query failed {attempt + 1} times, last error '
+                                                 f'{e!r}', True) from e
+                    time.sleep(self.backoff(attempt))
+                    continue
+
+                self.breaker.record_success()
+                failed = False
+                return response
+        finally:
+            if self.observe and attempts:
+                self.observe(request_type, time.perf_counter() - start, attempts, failed)
+
+    def backoff(self, attempt):
+        """ Full jitter exponential backoff """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    @staticmethod
+    def is_retryable(exception):
+        if isinstance(exception, PlacesApiError):
+            return exception.status in RETRYABLE_STATUSES
+        try:
+            # googlemaps pulls in requests, only import it once a request failed
+            from googlemaps import exceptions as gmaps_exceptions
+        except ImportError:
+            # Offline backend without googlemaps installed, the error is not a Places error
+            return False
+
+        if isinstance(exception, gmaps_exceptions.ApiError):
+            return exception.status in RETRYABLE_STATUSES
+        if isinstance(exception, gmaps_exceptions.HTTPError):
+            return str(exception.status_code).startswith('5') or exception.status_code == 429
+        return isinstance(exception, (gmaps_exceptions.Timeout, gmaps_exceptions.TransportError))
+
+    @staticmethod
+    def is_billed(exception):
+        """ Unbilled error statuses and requests whose connection to Google could not be opened are not billed. A
+            timeout, a 5xx answer or a connection lost after sending may have been processed by Google, so they are
+            kept charged to stay on the safe side of the monthly limit. """
+        if isinstance(exception, PlacesApiError):
+            return exception.status not in UNBILLED_STATUSES
+        try:
+            import requests
+            from googlemaps import exceptions as gmaps_exceptions
+            from urllib3.exceptions import NewConnectionError
+        except ImportError:
+            # Offline backend without googlemaps installed, nothing was sent to Google
+            return False
+
+        if isinstance(exception, gmaps_exceptions.ApiError):
+            return exception.status not in UNBILLED_STATUSES
+        if isinstance(exception, gmaps_exceptions.HTTPError):
+            return True
+        if isinstance(exception, gmaps_exceptions.TransportError):
+            # requests wraps the urllib3 MaxRetryError whose reason is the error opening the connection
+            base_exception = exception.base_exception
+            if isinstance(base_exception, requests.exceptions.ConnectionError) and base_exception.args:
+                return not isinstance(getattr(base_exception.args[0], 'reason', None), NewConnectionError)
+            return True
+        # Not a Places error (e.g. invalid arguments), raised before sending
+        return isinstance(exception, gmaps_exceptions.Timeout)
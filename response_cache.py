@@ -0,0 +1,197 @@
+import configparser
+import hashlib
+import json
+import sqlite3
+import sys
+import threading
+import time
+
+
+class CacheMissError(Exception):
+    """Raised in replay mode when a request has no cached response"""
+
+
+class ResponseCache:
+    """ Persistent cache of Google Places responses, keyed by request type plus a hash of the normalized params.
+        Entries expire after the TTL of their request type and the least recently used ones are evicted when the
+        cache grows over max_size_bytes.
+
+        In replay mode responses are only served from the cache, which allows re-running the parsing and storage
+        code against recorded data without any cost or network latency.
+    """
+
+    MODES = ('off', 'on', 'replay')
+
+    def __init__(self, path, ttls, max_size_bytes, replay=False):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.ttls = ttls
+        self.max_size_bytes = max_size_bytes
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS response_cache (
+                cache_key TEXT PRIMARY KEY,
+                request_type TEXT,
+                params TEXT,
+                response TEXT,
+                size INTEGER,
+                created_at REAL,
+                accessed_at REAL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_accessed_at ON response_cache (accessed_at)')
+        self.conn.commit()
+        self.size = self.conn.execute('SELECT IFNULL(SUM(size), 0) FROM response_cache').fetchone()[0]
+
+    @classmethod
+    def from_config(cls, config):
+        """ Builds the cache from the [CACHE] section of config.ini, returns None if the cache is disabled """
+        if not config.has_section('CACHE'):
+            return None
+
+        cache_config = config['CACHE']
+        mode = cache_config.get('Mode', fallback='off').lower()
+        if mode not in cls.MODES:
+            raise ValueError(f'Invalid cache Mode {mode}, use one of {", ".join(cls.MODES)}')
+        if mode == 'off':
+            return None
+
+        ttls = {
+            'place_details': cache_config.getfloat('PlaceDetailsTtlHours', fallback=168) * 3600,
+            'text_search': cache_config.getfloat('TextSearchTtlHours', fallback=24) * 3600,
+        }
+        return cls(cache_config.get('Path', fallback='cache.db'), ttls,
+                   int(cache_config.getfloat('MaxSizeMb', fallback=200) * 1024 * 1024), replay=mode == 'replay')
+
+    @staticmethod
+    def make_key(request_type, params):
+        """ Hash of the request type and params, the order of the params and of the requested fields is ignored """
+        normalized = {key: sorted(value) if isinstance(value, (list, tuple)) else value
+                      for key, value in params.items()}
+        payload = json.dumps([request_type, normalized], sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, request_type, params):
+        """ Returns the cached response or None if it is missing or expired """
+        cache_key = self.make_key(request_type, params)
+        now = time.time()
+
+        with self.lock:
+            row = self.conn.execute('SELECT response, created_at FROM response_cache WHERE cache_key = ?',
+                                    (cache_key,)).fetchone()
+            # Recorded data never expires in replay mode
+            if row is None or (not self.replay and now - row[1] > self.ttls.get(request_type, 0)):
+                self.misses += 1
+                return None
+
+            self.conn.execute('UPDATE response_cache SET accessed_at = ? WHERE cache_key = ?', (now, cache_key))
+            self.conn.commit()
+            self.hits += 1
+
+        return json.loads(row[0])
+
+    def set(self, request_type, params, response):
+        if request_type not in self.ttls:
+            return
+
+        cache_key = self.make_key(request_type, params)
+        serialized = json.dumps(response, ensure_ascii=False, separators=(',', ':'))
+        size = len(serialized.encode('utf-8'))
+        now = time.time()
+
+        with self.lock:
+            previous = self.conn.execute('SELECT size FROM response_cache WHERE cache_key = ?',
+                                         (cache_key,)).fetchone()
+            self.conn.execute('''
+                INSERT OR REPLACE INTO response_cache
+                (cache_key, request_type, params, response, size, created_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (cache_key, request_type, json.dumps(params, sort_keys=True, ensure_ascii=False), serialized, size,
+                  now, now))
+            self.size += size - (previous[0] if previous else 0)
+
+            if self.size > self.max_size_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        """ Deletes the least recently used entries until the cache is back to 90% of its maximum size """
+        target = self.max_size_bytes * 0.9
+        rows = self.conn.execute('SELECT cache_key, size FROM response_cache ORDER BY accessed_at ASC')
+        evicted_keys = []
+        for cache_key, size in rows:
+            if self.size <= target:
+                break
+            evicted_keys.append((cache_key,))
+            self.size -= size
+        rows.close()
+
+        self.conn.executemany('DELETE FROM response_cache WHERE cache_key = ?', evicted_keys)
+        self.evictions += len(evicted_keys)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            'evictions': self.evictions,
+            'size_bytes': self.size,
+        }
+
+    def export_jsonl(self, path):
+        """ Writes every cached response as one JSON line, returns the number of exported entries """
+        count = 0
+        with self.lock, open(path, 'w', encoding='utf-8') as file:
+            for request_type, params, response, created_at in self.conn.execute(
+                    'SELECT request_type, params, response, created_at FROM response_cache ORDER BY created_at'):
+                file.write(json.dumps({
+                    'request_type': request_type,
+                    'params': json.loads(params),
+                    'response': json.loads(response),
+                    'created_at': created_at,
+                }, ensure_ascii=False) + '\n')
+                count += 1
+        return count
+
+    def import_jsonl(self, path):
+        """ Seeds the cache from a file written by export_jsonl, returns the number of imported entries """
+        count = 0
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self.set(entry['request_type'], entry['params'], entry['response'])
+                count += 1
+        return count
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+if __name__ == '__main__':
+    # python response_cache.py export|import file.jsonl
+    if len(sys.argv) != 3 or sys.argv[1] not in ('export', 'import'):
+        print('Usage: python response_cache.py export|import file.jsonl')
+        exit(1)
+
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    cache = ResponseCache.from_config(config)
+    if cache is None:
+        print('The response cache is disabled, set Mode in the [CACHE] section of your config.ini')
+        exit(1)
+
+    if sys.argv[1] == 'export':
+        print(f'Exported {cache.export_jsonl(sys.argv[2])} responses')
+    else:
+        print(f'Imported {cache.import_jsonl(sys.argv[2])} responses')
+    cache.close()
@@ -0,0 +1,210 @@
+import bisect
+import datetime
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets, the last one catches everything else
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+
+class Histogram:
+    """ Latency histogram with fixed buckets, cheap enough to observe every request and SQL statement """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q quantile """
+        if not self.count:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return bound
+        return self.buckets[-1]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+class RequestStats:
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.cost = 0.0
+
+    def summary(self):
+        return dict(self.latency.summary(), errors=self.errors, retries=self.retries, bytes=self.bytes,
+                    cost=round(self.cost, 6))
+
+
+class StatementStats:
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+
+    def summary(self):
+        return dict(self.latency.summary(), rows=self.rows)
+
+
+class RunMetrics:
+    """ Where the time and money of a run go: latency, retries, errors, bytes and cost per request type, timing of
+        the SQLite statements on the hot paths and rows stored per (section, query). Thread safe, the request
+        workers record into the same instance.
+
+        report() returns the whole run as a dict, written as a JSON line by write_jsonl and in the Prometheus text
+        format by write_prometheus (for the node_exporter textfile collector).
+    """
+
+    def __init__(self, run_name=None):
+        self.run_name = run_name
+        self.started_at = datetime.datetime.now()
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.statements = {}
+        self.section_rows = {}
+
+    def observe_request(self, request_type, seconds, attempts, failed):
+        with self.lock:
+            stats = self.requests.setdefault(request_type, RequestStats())
+            stats.latency.observe(seconds)
+            stats.retries += max(0, attempts - 1)
+            stats.errors += failed
+
+    def add_bytes(self, request_type, size):
+        with self.lock:
+            self.requests.setdefault(request_type, RequestStats()).bytes += size
+
+    def add_cost(self, request_type, cost):
+        """ Charged cost, refunds are negative """
+        with self.lock:
+            stats = self.requests.setdefault(request_type, RequestStats())
+            stats.cost = round(stats.cost + cost, 6)
+
+    @contextmanager
+    def timed_sql(self, statement, rows=0):
+        """ Times the statements run inside the block under the name statement """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                stats = self.statements.setdefault(statement, StatementStats())
+                stats.latency.observe(elapsed)
+                stats.rows += rows
+
+    def count_rows(self, section_id, query, rows, new_places=0):
+        with self.lock:
+            key = (section_id, query)
+            stored, new = self.section_rows.get(key, (0, 0))
+            self.section_rows[key] = (stored + rows, new + new_places)
+
+    def report(self):
+        with self.lock:
+            return {
+                'run': self.run_name,
+                'started_at': self.started_at.strftime('%Y-%m-%d %H:%M:%S'),
+                'duration': round(time.perf_counter() - self.start, 3),
+                'requests': {request_type: stats.summary() for request_type, stats in self.requests.items()},
+                'cost': round(sum(stats.cost for stats in self.requests.values()), 6),
+                'sql': {statement: stats.summary() for statement, stats in self.statements.items()},
+                'rows': [{'section_id': section_id, 'query': query, 'rows': rows, 'new_places': new_places}
+                         for (section_id, query), (rows, new_places) in self.section_rows.items()],
+            }
+
+    def write_jsonl(self, path):
+        """ Appends the run report to a JSON lines file """
+        _make_parent_dir(path)
+        with open(path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(self.report(), ensure_ascii=False) + '\n')
+
+    def write_prometheus(self, path):
+        """ Writes the run metrics in the Prometheus text format, replacing the file atomically """
+        report = self.report()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            lines.extend(samples)
+
+        with self.lock:
+            histograms = {
+                ('places_request_duration_seconds', 'request_type'): self.requests,
+                ('places_sqlite_statement_duration_seconds', 'statement'): self.statements,
+            }
+            for (name, label), stats_by_name in histograms.items():
+                samples = []
+                for key, stats in stats_by_name.items():
+                    samples.extend(_histogram_samples(name, f'{label}="{_escape(key)}"', stats.latency))
+                metric(name, 'histogram', f'Duration of the {label.replace("_", " ")}s in seconds', samples)
+
+        for field, help_text in (('errors', 'Requests that finally failed'), ('retries', 'Retried attempts'),
+                                 ('bytes', 'Size of the JSON responses'), ('cost', 'API cost in $')):
+            metric(f'places_request_{field}_total', 'counter', help_text, [
+                f'places_request_{field}_total{{request_type="{_escape(request_type)}"}} {summary[field]}'
+                for request_type, summary in report['requests'].items()
+            ])
+
+        for field, help_text in (('rows', 'Companies stored by the crawl'),
+                                 ('new_places', 'Companies found for the first time by the crawl')):
+            by_query = {}
+            for row in report['rows']:
+                by_query[row['query']] = by_query.get(row['query'], 0) + row[field]
+            metric(f'places_crawl_{field}_total', 'counter', help_text, [
+                f'places_crawl_{field}_total{{query="{_escape(query)}"}} {value}' for query, value in by_query.items()
+            ])
+        metric('places_run_duration_seconds', 'gauge', 'Duration of the run',
+               [f'places_run_duration_seconds{{run="{_escape(report["run"] or "")}"}} {report["duration"]}'])
+
+        _make_parent_dir(path)
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+
+def _histogram_samples(name, labels, histogram):
+    samples = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        samples.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+    samples.append(f'{name}_sum{{{labels}}} {round(histogram.sum, 6)}')
+    samples.append(f'{name}_count{{{labels}}} {histogram.count}')
+    return samples
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _make_parent_dir(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
@@ -0,0 +1,150 @@
+import math
+
+EARTH_RADIUS = 6371000
+GOLDEN_ANGLE = math.pi * (3 - math.sqrt(5))
+# Text search never returns more than 3 pages of 20 results for a query
+RESULTS_CAP = 60
+EXPECTED_PAGES_PER_QUERY = 3
+# Children at (±r/2, ±r/2) need a radius of r/√2 to cover the whole parent circle
+CHILD_RADIUS_RATIO = math.sqrt(2) / 2
+QUADRANTS = (('NE', 1, 1), ('NW', -1, 1), ('SE', 1, -1), ('SW', -1, -1))
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """ Haversine distance in meters """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def offset(lat, lon, east, north):
+    """ Moves a point east and north meters """
+    new_lat = lat + math.degrees(north / EARTH_RADIUS)
+    new_lon = lon + math.degrees(east / (EARTH_RADIUS * math.cos(math.radians(lat))))
+    return new_lat, new_lon
+
+
+class GridIndex:
+    """ Spatial index of search circles: each circle is stored in every grid cell its bounding box touches, so
+        only the circles of the cells around a point have to be checked """
+
+    def __init__(self, cell_size=25000):
+        self.cell_size = cell_size
+        self.cells = {}
+
+    def _cell(self, lat, lon):
+        # Cells are cell_size meters tall and about cell_size meters wide at the latitudes of Spain
+        return (math.floor(math.radians(lat) * EARTH_RADIUS / self.cell_size),
+                math.floor(math.radians(lon) * EARTH_RADIUS * math.cos(math.radians(40)) / self.cell_size))
+
+    def _cells_around(self, lat, lon, radius):
+        min_lat, min_lon = offset(lat, lon, -radius, -radius)
+        max_lat, max_lon = offset(lat, lon, radius, radius)
+        (min_row, min_col), (max_row, max_col) = self._cell(min_lat, min_lon), self._cell(max_lat, max_lon)
+        for row in range(min_row, max_row + 1):
+            for col in range(min_col, max_col + 1):
+                yield row, col
+
+    def insert(self, section):
+        for cell in self._cells_around(section['lat'], section['lon'], section['radius']):
+            self.cells.setdefault(cell, []).append(section)
+
+    def covering(self, lat, lon):
+        """ Returns the circles containing the point """
+        return [section for section in self.cells.get(self._cell(lat, lon), [])
+                if distance(lat, lon, section['lat'], section['lon']) <= section['radius']]
+
+
+class SectionPlanner:
+    """ Decides which sections are worth a text search. Every section is a search circle: those mostly covered by
+        circles already searched recently are skipped, and the areas where a query hits the 60 results cap are split
+        into four smaller circles to be searched on later runs.
+
+        Only finished searches cover anything: sections planned in the same run may not be searched yet, and the
+        results of the split ones were truncated by the cap. Split sections are searched through their children.
+    """
+
+    def __init__(self, queries, search_cost, skip_ratio=0.9, min_radius=2000, samples=64,
+                 population_thresholds=(0, 50000, 150000, 300000)):
+        self.queries = queries
+        self.search_cost = search_cost
+        self.skip_ratio = skip_ratio
+        self.min_radius = min_radius
+        self.population_thresholds = population_thresholds
+        # Sunflower pattern: evenly spread sample points over the unit disk
+        self.sample_points = [(math.sqrt((i + 0.5) / samples), i * GOLDEN_ANGLE) for i in range(samples)]
+
+    def queries_for(self, population):
+        """
+        Dynamically adjust the number of queries based on the population size.
+        If the population is below certain thresholds, fewer queries are used.
+        This is determined by comparing the population to a list of thresholds and counting
+        how many thresholds are exceeded, which corresponds to the number of queries to use.
+        """
+        num_queries = sum(population >= threshold for threshold in self.population_thresholds)
+        return self.queries[:num_queries]
+
+    def estimated_cost(self, section):
+        return len(self.queries_for(section['population'])) * EXPECTED_PAGES_PER_QUERY * self.search_cost
+
+    def coverage(self, section, index):
+        """ Returns the fraction of the section covered by the circles of the index and the section covering most
+            of it """
+        covered = 0
+        coverers = {}
+        for distance_ratio, angle in self.sample_points:
+            radius = distance_ratio * section['radius']
+            lat, lon = offset(section['lat'], section['lon'], radius * math.cos(angle), radius * math.sin(angle))
+            circles = [circle for circle in index.covering(lat, lon) if circle['section_id'] != section['section_id']]
+            if circles:
+                covered += 1
+                for circle in circles:
+                    coverers[circle['section_id']] = coverers.get(circle['section_id'], 0) + 1
+
+        main_coverer = max(coverers, key=coverers.get) if coverers else None
+        return covered / len(self.sample_points), main_coverer
+
+    def plan(self, candidates, recently_searched, limit):
+        """ Picks up to limit sections to search among the candidates (most outdated first), split sections are
+            left out. Returns the sections to search and the skipped ones as (section, covering section_id, estimated
+            cost saved) """
+        index = GridIndex()
+        for section in recently_searched:
+            index.insert(section)
+
+        to_search, skipped = [], []
+        for section in candidates:
+            if len(to_search) >= limit:
+                break
+            if section.get('subdivided'):
+                continue
+
+            ratio, coverer = self.coverage(section, index)
+            if ratio >= self.skip_ratio:
+                skipped.append((section, coverer, self.estimated_cost(section)))
+                continue
+
+            to_search.append(section)
+
+        return to_search, skipped
+
+    def subdivide(self, section):
+        """ Returns the four sections covering a section whose searches hit the results cap, or nothing if they would
+            be smaller than min_radius """
+        radius = section['radius'] * CHILD_RADIUS_RATIO
+        if radius < self.min_radius:
+            return []
+
+        children = []
+        for name, east, north in QUADRANTS:
+            lat, lon = offset(section['lat'], section['lon'], east * section['radius'] / 2,
+                              north * section['radius'] / 2)
+            children.append({
+                'name': f"{section['name']} {name}",
+                'lat': round(lat, 6),
+                'lon': round(lon, 6),
+                'population': section['population'] / 4,
+                'radius': round(radius),
+                'parent_section_id': section['section_id'],
+            })
+        return children
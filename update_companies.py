@@ -1,6 +1,7 @@
-from google_places_manager import GooglePlacesManager
+import sys
 
-# Initialization and usage of the class
-manager = GooglePlacesManager()
+from cli import main
 
-manager.update_companies()
+# Same as `python cli.py crawl`: resumes the unfinished crawl job if any, run several of these processes to crawl a
+# job in parallel
+sys.exit(main(['crawl']))
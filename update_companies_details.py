@@ -1,9 +1,9 @@
-from google_places_manager import GooglePlacesManager
+import sys
 
-# Initialization and usage of the class
-manager = GooglePlacesManager()
+from cli import main
 
+# Same as `python cli.py refresh --days 30 --limit 200`
 frequency_days_to_update = 30
 limit = 200
 
-manager.update_company_details(frequency_days_to_update, limit)
+sys.exit(main(['refresh', '--days', str(frequency_days_to_update), '--limit', str(limit)]))